@@ -0,0 +1,448 @@
+"""A local fake of the GitHub API endpoints Label Bot uses."""
+import asyncio
+import base64
+import hashlib
+import random
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from aiohttp import web
+
+RE_TARGET = re.compile(r'/(?:issues|pulls)/(\d+)(?:/|$)')
+RE_STATUS = re.compile(r'/statuses/([0-9a-f]{40})$')
+
+LABEL_WRITES = frozenset(['POST', 'PUT', 'DELETE'])
+
+
+class Call(namedtuple('Call', ['time', 'method', 'path', 'status', 'target'])):
+    """A recorded API call."""
+
+
+def sha_for(number):
+    """Get the head SHA the fake uses for an issue or pull request number."""
+
+    return f'{number:040x}'
+
+
+def target_for(path):
+    """Get the issue or pull request number an API call belongs to, if any."""
+
+    m = RE_TARGET.search(path)
+    if m is not None:
+        return int(m.group(1))
+    m = RE_STATUS.search(path)
+    if m is not None:
+        return int(m.group(1), 16)
+    return None
+
+
+def is_label_write(call):
+    """Check if the call changed an issue's labels."""
+
+    return call.method in LABEL_WRITES and '/labels' in call.path and call.target is not None
+
+
+class FakeGitHub:
+    """
+    Serve the GitHub API endpoints Label Bot uses from memory.
+
+    Every call is delayed by `latency` (plus up to `jitter`) seconds and recorded. Responses carry
+    rate limit headers for a budget of `rate_limit` calls per `window` seconds, and once the budget
+    is used up calls fail with a 403 until the window resets. Like on GitHub, the app (authenticated
+    with a JWT), each installation token, and any other token each have their own budget. Reads send
+    an `ETag` and answer a matching `If-None-Match` with a 304 that is not counted against the budget.
+    Installation tokens last `token_ttl` seconds. Every issue number is treated as a pull request that
+    changes `files` files.
+    """
+
+    def __init__(
+        self, config, bot='label-bot', latency=0.0, jitter=0.0, rate_limit=5000, window=3600, files=10, token_ttl=3600
+    ):
+        """Initialize."""
+
+        self.config = config.encode('utf-8')
+        self.bot = bot
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.window = window
+        self.files = files
+        self.token_ttl = token_ttl
+        self.budgets = {}
+        self.tokens = {}
+        self.calls = []
+        self.repo_labels = {}
+        self.issue_labels = {}
+        self.statuses = {}
+        self.comments = 0
+        self.reactions = 0
+
+    def app(self):
+        """Create the web application."""
+
+        app = web.Application(middlewares=[self.middleware])
+        repo = '/repos/{owner}/{repo}'
+        app.add_routes([
+            web.get(repo + '/contents/{path:.+}', self.contents),
+            web.get(repo + '/branches/{branch}', self.branch),
+            web.get(repo + '/compare/{basehead}', self.compare),
+            web.get(repo + '/pulls/{number:\\d+}', self.pull),
+            web.get(repo + '/pulls/{number:\\d+}/files', self.pull_files),
+            web.get(repo + '/issues/comments/{id:\\d+}', self.comment),
+            web.post(repo + '/issues/comments/{id:\\d+}/reactions', self.reaction),
+            web.get(repo + '/issues/{number:\\d+}', self.issue),
+            web.post(repo + '/issues/{number:\\d+}/reactions', self.reaction),
+            web.post(repo + '/issues/{number:\\d+}/comments', self.post_comment),
+            web.get(repo + '/issues/{number:\\d+}/labels', self.get_issue_labels),
+            web.post(repo + '/issues/{number:\\d+}/labels', self.add_issue_labels),
+            web.put(repo + '/issues/{number:\\d+}/labels', self.set_issue_labels),
+            web.delete(repo + '/issues/{number:\\d+}/labels/{name}', self.remove_issue_label),
+            web.get(repo + '/labels', self.get_labels),
+            web.post(repo + '/labels', self.add_label),
+            web.patch(repo + '/labels/{name}', self.edit_label),
+            web.delete(repo + '/labels/{name}', self.remove_label),
+            web.post(repo + '/statuses/{sha}', self.status),
+            web.post('/app/installations/{id:\\d+}/access_tokens', self.access_token),
+            web.post('/graphql', self.graphql)
+        ])
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """Delay, rate limit, cache, and record every call."""
+
+        delay = self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        now = time.time()
+        bucket = self.bucket(request)
+        resource = 'graphql' if request.path == '/graphql' else 'core'
+        if bucket is not None and resource != 'core':
+            bucket = f'{bucket}:{resource}'
+        budget = self.budgets.setdefault(bucket, [self.rate_limit, now + self.window])
+        if now >= budget[1]:
+            budget[:] = [self.rate_limit, now + self.window]
+
+        if bucket is None:
+            response = web.json_response({'message': 'Bad credentials'}, status=401)
+        elif budget[0] <= 0:
+            response = web.json_response({'message': 'API rate limit exceeded'}, status=403)
+        else:
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                response = web.json_response({'message': e.reason}, status=e.status)
+
+            if request.method == 'GET' and response.status == 200:
+                etag = '"' + hashlib.sha1(response.body).hexdigest() + '"'
+                if request.headers.get('If-None-Match') == etag:
+                    response = web.Response(status=304)
+                response.headers['ETag'] = etag
+
+            if response.status != 304:
+                budget[0] -= 1
+
+        response.headers['X-RateLimit-Limit'] = str(self.rate_limit)
+        response.headers['X-RateLimit-Remaining'] = str(budget[0])
+        response.headers['X-RateLimit-Reset'] = str(int(budget[1]))
+        response.headers['X-RateLimit-Used'] = str(self.rate_limit - budget[0])
+        response.headers['X-RateLimit-Resource'] = resource
+
+        self.calls.append(Call(time.time(), request.method, request.path, response.status, target_for(request.path)))
+        return response
+
+    def bucket(self, request):
+        """Get the rate limit budget a call counts against, or `None` if its installation token expired."""
+
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer':
+            return 'app'
+        installation = self.tokens.get(credentials)
+        if installation is not None:
+            return f'installation-{installation[0]}' if installation[1] > time.time() else None
+        return 'token'
+
+    def paginate(self, request, items):
+        """Respond with one page of the items and a `Link` header to the others."""
+
+        per_page = min(100, int(request.query.get('per_page', 30)))
+        page = int(request.query.get('page', 1))
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        response = web.json_response(items[(page - 1) * per_page:page * per_page])
+
+        links = []
+        if page < last:
+            links.append(f'<{request.url.update_query(page=page + 1)}>; rel="next"')
+            links.append(f'<{request.url.update_query(page=last)}>; rel="last"')
+        if links:
+            response.headers['Link'] = ', '.join(links)
+        return response
+
+    def blob_sha(self):
+        """Get the blob SHA of the configuration file."""
+
+        return hashlib.sha1(b'blob %d\0' % len(self.config) + self.config).hexdigest()
+
+    def repo_url(self, request):
+        """Get the API URL of the requested repository."""
+
+        return f'{request.url.origin()}/repos/{request.match_info["owner"]}/{request.match_info["repo"]}'
+
+    def label(self, name):
+        """Get a label, creating it if the repository doesn't have it yet."""
+
+        label = self.repo_labels.get(name.lower())
+        if label is None:
+            label = self.repo_labels[name.lower()] = {'name': name, 'color': 'ededed', 'description': ''}
+        return label
+
+    async def contents(self, request):
+        """Get a file."""
+
+        if request.match_info['path'] != '.github/labels.yml':
+            raise web.HTTPNotFound()
+
+        return web.json_response(
+            {
+                'type': 'file',
+                'encoding': 'base64',
+                'path': request.match_info['path'],
+                'sha': self.blob_sha(),
+                'content': base64.b64encode(self.config).decode('ascii')
+            }
+        )
+
+    async def branch(self, request):
+        """Get a branch."""
+
+        return web.json_response({'name': request.match_info['branch'], 'commit': {'sha': sha_for(0)}})
+
+    def changed_files(self, number):
+        """Get the files a pull request changes."""
+
+        folders = ('label_bot', 'tests', 'docs/src/markdown', '.github/workflows', 'benchmarks/data')
+        extensions = ('py', 'md', 'yml', 'json')
+        return [
+            {
+                'filename': f'{folders[i % len(folders)]}/file{number}_{i}.{extensions[i % len(extensions)]}',
+                'status': 'modified'
+            }
+            for i in range(self.files)
+        ]
+
+    async def compare(self, request):
+        """Compare two commits."""
+
+        return web.json_response({'files': self.changed_files(0)})
+
+    async def pull(self, request):
+        """Get a pull request."""
+
+        number = int(request.match_info['number'])
+        url = self.repo_url(request)
+        return web.json_response(
+            {
+                'url': f'{url}/pulls/{number}',
+                'issue_url': f'{url}/issues/{number}',
+                'number': number,
+                'state': 'open',
+                'body_html': '<p>Sample pull request.</p>',
+                'author_association': 'CONTRIBUTOR',
+                'labels': list(self.issue_labels.get(number, {}).values()),
+                'head': {'sha': sha_for(number), 'label': 'contributor:feature'},
+                'base': {'sha': sha_for(0), 'label': 'octo-org:master'}
+            }
+        )
+
+    async def pull_files(self, request):
+        """List the files a pull request changes."""
+
+        return self.paginate(request, self.changed_files(int(request.match_info['number'])))
+
+    async def issue(self, request):
+        """Get an issue."""
+
+        number = int(request.match_info['number'])
+        url = self.repo_url(request)
+        return web.json_response(
+            {
+                'url': f'{url}/issues/{number}',
+                'number': number,
+                'state': 'open',
+                'body_html': '<p>Sample issue.</p>',
+                'author_association': 'CONTRIBUTOR',
+                'labels': list(self.issue_labels.get(number, {}).values()),
+                'pull_request': {'url': f'{url}/pulls/{number}'}
+            }
+        )
+
+    async def comment(self, request):
+        """Get a comment that mentions the bot."""
+
+        bot = self.bot
+        return web.json_response(
+            {
+                'id': int(request.match_info['id']),
+                'body_html': (
+                    f'<p><a class="user-mention" href="https://github.com/{bot}">@{bot}</a> retrigger all</p>'
+                )
+            }
+        )
+
+    async def reaction(self, request):
+        """React to an issue or comment."""
+
+        self.reactions += 1
+        return web.json_response({'content': (await request.json())['content']}, status=201)
+
+    async def post_comment(self, request):
+        """Comment on an issue."""
+
+        self.comments += 1
+        return web.json_response({'body': (await request.json())['body']}, status=201)
+
+    async def get_issue_labels(self, request):
+        """List an issue's labels."""
+
+        labels = self.issue_labels.get(int(request.match_info['number']), {})
+        return self.paginate(request, list(labels.values()))
+
+    async def add_issue_labels(self, request):
+        """Add labels to an issue."""
+
+        labels = self.issue_labels.setdefault(int(request.match_info['number']), {})
+        for name in (await request.json())['labels']:
+            labels.setdefault(name.lower(), self.label(name))
+        return web.json_response(list(labels.values()))
+
+    async def set_issue_labels(self, request):
+        """Replace an issue's labels."""
+
+        labels = self.issue_labels[int(request.match_info['number'])] = {}
+        for name in (await request.json())['labels']:
+            labels.setdefault(name.lower(), self.label(name))
+        return web.json_response(list(labels.values()))
+
+    async def remove_issue_label(self, request):
+        """Remove a label from an issue."""
+
+        labels = self.issue_labels.get(int(request.match_info['number']), {})
+        if labels.pop(request.match_info['name'].lower(), None) is None:
+            raise web.HTTPNotFound(reason='Label does not exist')
+        return web.json_response(list(labels.values()))
+
+    async def get_labels(self, request):
+        """List the repository's labels."""
+
+        return self.paginate(request, list(self.repo_labels.values()))
+
+    async def add_label(self, request):
+        """Create a repository label."""
+
+        data = await request.json()
+        if data['name'].lower() in self.repo_labels:
+            error = {'resource': 'Label', 'code': 'already_exists', 'field': 'name'}
+            return web.json_response({'message': 'Validation Failed', 'errors': [error]}, status=422)
+        label = self.repo_labels[data['name'].lower()] = {
+            'name': data['name'], 'color': data['color'], 'description': data.get('description', '')
+        }
+        return web.json_response(label, status=201)
+
+    async def edit_label(self, request):
+        """Edit a repository label."""
+
+        data = await request.json()
+        label = self.repo_labels.pop(request.match_info['name'].lower(), None)
+        if label is None:
+            raise web.HTTPNotFound()
+        label = dict(label, name=data.get('new_name', label['name']))
+        label.update((key, data[key]) for key in ('color', 'description') if key in data)
+        self.repo_labels[label['name'].lower()] = label
+        return web.json_response(label)
+
+    async def remove_label(self, request):
+        """Delete a repository label."""
+
+        if self.repo_labels.pop(request.match_info['name'].lower(), None) is None:
+            raise web.HTTPNotFound()
+        return web.Response(status=204)
+
+    async def access_token(self, request):
+        """Create an installation access token."""
+
+        if len(request.headers.get('Authorization', '').partition(' ')[2].split('.')) != 3:
+            raise web.HTTPUnauthorized(reason='A JSON web token could not be decoded')
+
+        installation = int(request.match_info['id'])
+        token = f'ghs_{installation}_{len(self.tokens)}'
+        expires = time.time() + self.token_ttl
+        self.tokens[token] = (installation, expires)
+        expires_at = datetime.fromtimestamp(int(expires), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return web.json_response({'token': token, 'expires_at': expires_at}, status=201)
+
+    def files_page(self, number, after):
+        """Get a GraphQL page of the files a pull request changes."""
+
+        files = self.changed_files(number)
+        start = int(after or 0)
+        end = start + 100
+        return {
+            'nodes': [{'path': file['filename'], 'changeType': 'MODIFIED'} for file in files[start:end]],
+            'pageInfo': {'hasNextPage': end < len(files), 'endCursor': str(end)}
+        }
+
+    def labels_page(self, number):
+        """Get a GraphQL page of an issue's labels."""
+
+        labels = list(self.issue_labels.get(number, {}).values())
+        return {
+            'nodes': [{'name': label['name']} for label in labels[:100]],
+            'pageInfo': {'hasNextPage': len(labels) > 100}
+        }
+
+    async def graphql(self, request):
+        """
+        Answer the GraphQL queries Label Bot makes.
+
+        Queries aren't parsed, the fields that are asked for are recognized by name.
+        """
+
+        body = await request.json()
+        text = body['query']
+        variables = body.get('variables', {})
+        number = variables['number']
+
+        if 'issueOrPullRequest' in text:
+            item = {
+                '__typename': 'PullRequest',
+                'number': number,
+                'state': 'OPEN',
+                'headRefOid': sha_for(number),
+                'headRefName': 'feature',
+                'headRepositoryOwner': {'login': 'contributor'},
+                'baseRefOid': sha_for(0),
+                'baseRefName': 'master',
+                'baseRepository': {'owner': {'login': variables['owner']}},
+                'labels': self.labels_page(number)
+            }
+            return web.json_response({'data': {'repository': {'issueOrPullRequest': item}}})
+
+        pull_request = {'files': self.files_page(number, variables.get('after'))}
+        if 'labels(' in text:
+            pull_request['state'] = 'OPEN'
+            pull_request['labels'] = self.labels_page(number)
+        repository = {'pullRequest': pull_request}
+        if variables.get('config'):
+            path = variables['expression'].split(':', 1)[1]
+            blob = {'oid': self.blob_sha(), 'text': self.config.decode('utf-8'), 'isTruncated': False}
+            repository['config'] = blob if path == '.github/labels.yml' else None
+        return web.json_response({'data': {'repository': repository}})
+
+    async def status(self, request):
+        """Set a commit status."""
+
+        data = await request.json()
+        self.statuses.setdefault(request.match_info['sha'], {})[data['context']] = data['state']
+        return web.json_response(data, status=201)
@@ -0,0 +1,307 @@
+"""
+Load test Label Bot against a local fake of the GitHub API.
+
+The bot is started as a separate process pointed at the fake with `GH_API_URL`, and a burst of
+signed webhooks built from the recorded payloads in `data` is sent to it. Any `GH_BOT_*` tuning
+variables set in the environment are passed through to the bot.
+
+    python -m benchmarks.load --kind pull_request_opened --events 200 --concurrency 20 --latency 0.05
+
+With `--installations`, the bot authenticates as a GitHub App with a throwaway key, and the events
+are spread over that many installations, each with its own token and rate limit.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+import aiohttp
+from aiohttp import web
+from label_bot import metrics
+from . import fake_github
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# The recorded payloads are rewritten per event, so each event targets its own issue or pull request.
+SAMPLE_API = 'https://api.github.com'
+SAMPLE_NUMBER = '1347'
+SAMPLE_SHA = '0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c'
+
+KINDS = {
+    'pull_request_opened': 'pull_request',
+    'pull_request_synchronize': 'pull_request',
+    'pull_request_labeled': 'pull_request',
+    'issues_opened': 'issues',
+    'issue_comment_created': 'issue_comment',
+    'push': 'push'
+}
+
+RE_JOBS = re.compile(r'^labelbot_jobs\{state="(\w+)"\} (\S+)$', re.M)
+
+
+def free_port():
+    """Get a free local port."""
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read(name):
+    """Read a file from the data folder."""
+
+    with open(os.path.join(DATA, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def build(template, number, installations=0):
+    """Build the webhook body for an event targeting the given issue or pull request number."""
+
+    body = template.replace(SAMPLE_NUMBER, str(number)).replace(SAMPLE_SHA, fake_github.sha_for(number))
+    if installations:
+        payload = json.loads(body)
+        payload['installation'] = {'id': (number - 1) % installations + 1}
+        body = json.dumps(payload)
+    return body.encode('utf-8')
+
+
+def private_key():
+    """Create a throwaway private key for the GitHub App."""
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode('ascii')
+
+
+def sign(body, secret):
+    """Sign the webhook body the way GitHub does."""
+
+    key = secret.encode('utf-8')
+    return {
+        'X-Hub-Signature': 'sha1=' + hmac.new(key, body, hashlib.sha1).hexdigest(),
+        'X-Hub-Signature-256': 'sha256=' + hmac.new(key, body, hashlib.sha256).hexdigest()
+    }
+
+
+def percentile(values, pct):
+    """Get the nearest rank percentile."""
+
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def summary(values):
+    """Summarize latencies in milliseconds."""
+
+    return ' '.join(
+        f'{name}={percentile(values, pct) * 1000:.1f}ms'
+        for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))
+    )
+
+
+async def get_jobs(session, bot_url):
+    """Get the number of active and pending jobs in the bot."""
+
+    async with session.get(f'{bot_url}/metrics') as response:
+        text = await response.text()
+    return sum(float(value) for _, value in RE_JOBS.findall(text))
+
+
+async def wait_for_bot(session, bot_url, process, timeout):
+    """Wait for the bot to accept requests."""
+
+    end = time.time() + timeout
+    while time.time() < end:
+        if process.returncode is not None:
+            raise RuntimeError(f'Label Bot exited with {process.returncode}')
+        try:
+            await get_jobs(session, bot_url)
+            return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('Label Bot did not start')
+
+
+async def wait_for_idle(session, bot_url, fake, start, settle, timeout):
+    """Wait until the bot has no jobs and has made no API calls for `settle` seconds."""
+
+    end = time.time() + timeout
+    while time.time() < end:
+        last = fake.calls[-1].time if fake.calls else start
+        if time.time() - last >= settle and not await get_jobs(session, bot_url):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def fire(session, bot_url, event_type, template, events, concurrency, secret, installations=0):
+    """Send a burst of signed webhooks and record when each was sent and acknowledged."""
+
+    sent = {}
+    acked = {}
+    failed = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def deliver(number):
+        """Deliver one webhook."""
+
+        body = build(template, number, installations)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event_type,
+            'X-GitHub-Delivery': str(uuid.uuid4())
+        }
+        headers.update(sign(body, secret))
+        async with limit:
+            sent[number] = time.time()
+            try:
+                async with session.post(bot_url, data=body, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        failed.append(number)
+            except aiohttp.ClientError:
+                failed.append(number)
+            acked[number] = time.time()
+
+    await asyncio.gather(*[deliver(number) for number in range(1, events + 1)])
+    return sent, acked, failed
+
+
+def report(args, fake, sent, acked, failed, elapsed, idle):
+    """Print the results."""
+
+    events = len(sent)
+    calls = fake.calls
+    last_label = {}
+    last_call = {}
+    for call in calls:
+        if call.target in sent:
+            last_call[call.target] = call.time
+            if fake_github.is_label_write(call):
+                last_label[call.target] = call.time
+
+    reads = sum(1 for call in calls if call.method == 'GET')
+    by_endpoint = Counter((call.method, metrics.endpoint(call.path)) for call in calls)
+
+    print(f'Events:               {events} {args.kind} ({len(failed)} failed)')
+    print(f'Deliveries/sec:       {events / elapsed:.1f}')
+    print(f'Acknowledge latency:  {summary([acked[n] - sent[n] for n in sent])}')
+    print(f'Label latency:        {summary([last_label[n] - sent[n] for n in last_label])} ({len(last_label)} events)')
+    print(f'Completion latency:   {summary([last_call[n] - sent[n] for n in last_call])} ({len(last_call)} events)')
+    print(f'API calls:            {len(calls)} ({reads} reads, {len(calls) - reads} writes)')
+    print(f'API calls per event:  {len(calls) / events:.2f}')
+    print(f'Not modified (304):   {sum(1 for call in calls if call.status == 304)}')
+    print(f'Rate limited (403):   {sum(1 for call in calls if call.status == 403)}')
+    print(f'Unauthorized (401):   {sum(1 for call in calls if call.status == 401)}')
+    for bucket, (remaining, _) in sorted(fake.budgets.items(), key=lambda item: str(item[0])):
+        if bucket is not None:
+            print(f'Rate limit remaining: {remaining}/{fake.rate_limit} ({bucket})')
+    if not idle:
+        print(f'WARNING: Label Bot was still busy after {args.timeout} seconds')
+    print()
+    for (method, endpoint), count in by_endpoint.most_common():
+        print(f'{count:8d}  {method:6s} {endpoint}')
+
+
+async def run(args):
+    """Run the load test."""
+
+    secret = uuid.uuid4().hex
+    fake = fake_github.FakeGitHub(
+        read('labels.yml'),
+        bot=args.bot,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        window=args.window,
+        files=args.files,
+        token_ttl=args.token_ttl
+    )
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    api_port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', api_port).start()
+    api_url = f'http://127.0.0.1:{api_port}'
+
+    bot_port = free_port()
+    bot_url = f'http://127.0.0.1:{bot_port}'
+    env = dict(os.environ)
+    env.update(
+        {
+            'PORT': str(bot_port),
+            'GH_SECRET': secret,
+            'GH_BOT': args.bot,
+            'GH_AUTH': 'benchmark',
+            'GH_API_URL': api_url
+        }
+    )
+    env.pop('GH_BOT_METRICS_TOKEN', None)
+    env.pop('GH_APP_ID', None)
+    env.pop('GH_APP_PRIVATE_KEY', None)
+    if args.installations:
+        env.update({'GH_APP_ID': '1', 'GH_APP_PRIVATE_KEY': private_key()})
+    log = open(args.log, 'w') if args.log else subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'label_bot', cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_for_bot(session, bot_url, process, args.timeout)
+            template = read(f'{args.kind}.json').replace(SAMPLE_API, api_url)
+            start = time.time()
+            sent, acked, failed = await fire(
+                session, bot_url, KINDS[args.kind], template, args.events, args.concurrency, secret, args.installations
+            )
+            elapsed = max(acked.values()) - start
+            idle = await wait_for_idle(session, bot_url, fake, start, args.settle, args.timeout)
+        report(args, fake, sent, acked, failed, elapsed, idle)
+    finally:
+        process.terminate()
+        await process.wait()
+        if args.log:
+            log.close()
+        await runner.cleanup()
+
+
+def main():
+    """Parse the arguments and run the load test."""
+
+    parser = argparse.ArgumentParser(prog='benchmarks.load', description='Load test Label Bot.')
+    parser.add_argument('--kind', choices=sorted(KINDS), default='pull_request_opened', help='Webhook to send.')
+    parser.add_argument('--events', type=int, default=100, help='Number of webhooks to send.')
+    parser.add_argument('--concurrency', type=int, default=10, help='Webhooks in flight at once.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each API call takes.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random seconds added to each API call.')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='API calls allowed per rate limit window.')
+    parser.add_argument('--window', type=float, default=3600, help='Seconds in a rate limit window.')
+    parser.add_argument('--files', type=int, default=10, help='Files changed by each pull request.')
+    parser.add_argument(
+        '--installations', type=int, default=0, help='Authenticate as an app with this many installations.'
+    )
+    parser.add_argument('--token-ttl', type=float, default=3600, help='Seconds an installation token lasts.')
+    parser.add_argument('--settle', type=float, default=1.0, help='Seconds without API calls before the bot is done.')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for the bot to finish.')
+    parser.add_argument('--bot', default='label-bot', help='Name of the bot user.')
+    parser.add_argument('--log', help='File to write the bot output to.')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
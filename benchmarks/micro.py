@@ -0,0 +1,362 @@
+"""
+Microbenchmarks for the CPU bound parts of Label Bot.
+
+Each benchmark is run on synthetic inputs of a few sizes. Results can be saved as a baseline,
+and later runs are compared against it, reporting anything that got slower than the threshold.
+
+    python -m benchmarks.micro --save
+    python -m benchmarks.micro --filter wildcard
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import itertools
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from label_bot import commands
+from label_bot import config as label_config
+from label_bot import sync_labels
+from label_bot import util
+from label_bot import wildcard_labels
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+BOT = 'label-bot'
+FOLDERS = (
+    'label_bot', 'docs/src/markdown', 'tests/unit', 'tests/integration', '.github/workflows', 'tools/scripts',
+    'assets/images'
+)
+EXTENSIONS = ('py', 'md', 'yml', 'json', 'txt', 'png')
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    """
+    Register a benchmark for every combination of the parameters.
+
+    The decorated function sets up the inputs and returns a `prepare` function that returns the
+    arguments for one call, and the function to time. Only the call is timed.
+    """
+
+    def decorator(function):
+        """Decorator."""
+
+        for values in itertools.product(*params.values()):
+            kwargs = dict(zip(params, values))
+            label = ','.join(f'{key}={value}' for key, value in kwargs.items())
+            BENCHMARKS.append((f'{name}[{label}]', functools.partial(function, **kwargs)))
+        return function
+    return decorator
+
+
+def make_files(count):
+    """Make a list of changed files."""
+
+    return [
+        f'{FOLDERS[i % len(FOLDERS)]}/pkg{i % 97}/file{i}.{EXTENSIONS[i % len(EXTENSIONS)]}'
+        for i in range(count)
+    ]
+
+
+def make_rules(count):
+    """Make wildcard rules with a mix of literal, directory, and glob patterns."""
+
+    rules = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            pattern = f'tools/scripts/pkg{i % 97}/file{i}.txt'
+        elif kind == 1:
+            pattern = f'tests/unit/pkg{i % 97}/**'
+        elif kind == 2:
+            pattern = f'**/*.{EXTENSIONS[i % len(EXTENSIONS)]}|!tests/**'
+        elif kind == 3:
+            pattern = f'docs/**/file{i}*.md'
+        else:
+            pattern = f'label_bot/pkg{i % 97}/*.py'
+        rules.append({'labels': [f'label-{i}', f'shared-{i % 7}'], 'patterns': [pattern]})
+    return rules
+
+
+def make_labels_config(count):
+    """Make a label configuration."""
+
+    colors = {f'color-{i}': f'#{i * 1118481:06x}' for i in range(10)}
+    labels = []
+    for i in range(count):
+        label = {
+            'name': f'label-{i}',
+            'color': f'color-{i % 10}' if i % 2 else f'#{i % 0xffffff:06x}',
+            'description': f'Label number {i}.'
+        }
+        if i % 10 == 0:
+            label['renamed'] = f'old-{i}'
+        labels.append(label)
+    return {'colors': colors, 'labels': labels, 'delete_labels': True}
+
+
+def make_repo_labels(config):
+    """Make repository labels that need a mix of renames, updates, deletes, and nothing at all."""
+
+    labels, _ = sync_labels._parse_labels(config)
+    repo_labels = []
+    for i, label in enumerate(labels):
+        if 'renamed' in label:
+            repo_labels.append({'name': label['renamed'], 'color': label['color'], 'description': ''})
+        elif i % 3 == 0:
+            repo_labels.append({'name': f'stale-{i}', 'color': 'ededed', 'description': ''})
+        elif i % 3 == 1:
+            repo_labels.append({'name': label['name'], 'color': label['color'], 'description': label['description']})
+        else:
+            repo_labels.append({'name': label['name'], 'color': 'ededed', 'description': label['description']})
+    return repo_labels
+
+
+def make_payload(labels):
+    """Make a pull request payload with the given number of labels."""
+
+    with open(os.path.join(DATA, 'pull_request_opened.json'), 'r', encoding='utf-8') as f:
+        payload = json.load(f)
+    payload['pull_request']['labels'] = [
+        {'id': i, 'name': f'label-{i} \U0001f680', 'color': 'ededed', 'default': False} for i in range(labels)
+    ]
+    return payload
+
+
+def make_comment(paragraphs):
+    """Make comment HTML with mentions of the bot between paragraphs, code, and quotes."""
+
+    mention = f'<a class="user-mention" data-hovercard-type="user" href="https://github.com/{BOT}">@{BOT}</a>'
+    parts = []
+    for i in range(paragraphs):
+        kind = i % 10
+        if kind == 0:
+            parts.append(f'<p>{mention} add bug, feature, label-{i}</p>')
+        elif kind == 3:
+            parts.append(f'<pre><code>@{BOT} remove label-{i}\nprint("{i}")</code></pre>')
+        elif kind == 6:
+            parts.append(f'<blockquote><p>{mention} retrigger all</p></blockquote>')
+        else:
+            parts.append(f'<p>Paragraph {i} with <code>code</code> and <a href="https://example.com">a link</a>.</p>')
+    return '\n'.join(parts)
+
+
+class PlanEvent:
+    """Stand-in for an event that counts repository label changes instead of making API calls."""
+
+    def __init__(self, repo_labels):
+        """Initialize."""
+
+        self.repo_labels = repo_labels
+        self.changes = 0
+
+    async def get_repo_labels(self, gh):
+        """Get the repository labels."""
+
+        for label in self.repo_labels:
+            yield label
+
+    async def update_repo_label(self, gh, old_name, new_name, color, description):
+        """Update the repository label."""
+
+        self.changes += 1
+
+    async def remove_repo_label(self, gh, label):
+        """Remove repository label."""
+
+        self.changes += 1
+
+    async def add_repo_label(self, gh, name, color, description):
+        """Add repository label."""
+
+        self.changes += 1
+
+
+@benchmark('wildcard_labels.get_labels', files=(10, 1000, 50000), rules=(5, 50, 500))
+def bench_get_labels(files, rules):
+    """Match changed files against wildcard rules."""
+
+    args = (make_rules(rules), make_files(files), wildcard_labels.get_flags({'minus_negate': False}))
+    return (lambda: args), wildcard_labels.get_labels
+
+
+@benchmark('sync_labels._parse_labels', labels=(10, 1000, 5000))
+def bench_parse_labels(labels):
+    """Parse and validate the label configuration."""
+
+    args = (make_labels_config(labels),)
+    return (lambda: args), sync_labels._parse_labels
+
+
+@benchmark('sync_labels._find_label', labels=(10, 1000, 5000))
+def bench_find_label(labels):
+    """Find the last configured label."""
+
+    parsed, _ = sync_labels._parse_labels(make_labels_config(labels))
+    last = parsed[-1]
+    args = (parsed, last['name'], 'ededed', last['description'], sync_labels._index_labels(parsed))
+    return (lambda: args), sync_labels._find_label
+
+
+@benchmark('sync_labels.sync', labels=(10, 1000, 5000))
+def bench_sync(labels):
+    """Plan a full label sync against repository labels that need a mix of changes."""
+
+    config = make_labels_config(labels)
+    repo_labels = make_repo_labels(config)
+    compiled = label_config.Config(config)
+    loop = asyncio.get_event_loop()
+
+    def call(event, config):
+        """Run the sync."""
+
+        loop.run_until_complete(sync_labels.sync(event, None, config))
+
+    return (lambda: (PlanEvent(repo_labels), compiled)), call
+
+
+@benchmark('commands.RE_COMMANDS', labels=(1, 100, 1000))
+def bench_re_commands(labels):
+    """Match a command that lists labels."""
+
+    args = (' add ' + ', '.join(f'label-{i}' for i in range(labels)),)
+    return (lambda: args), commands.RE_COMMANDS.match
+
+
+@benchmark('commands.find_commands', paragraphs=(10, 1000, 10000))
+def bench_find_commands(paragraphs):
+    """Find commands in comment HTML."""
+
+    args = (make_comment(paragraphs), BOT)
+    return (lambda: args), lambda body_html, bot: list(commands.find_commands(body_html, bot))
+
+
+@benchmark('util.Event', labels=(10, 1000, 10000))
+def bench_event(labels):
+    """Create an event from a pull request payload."""
+
+    args = ('pull_request', make_payload(labels))
+    return (lambda: args), util.Event
+
+
+@benchmark('util.Event.merge_config', labels=(10, 1000, 5000))
+def bench_merge_config(labels):
+    """Merge a local configuration into a large template."""
+
+    event = util.Event('pull_request', make_payload(0))
+    template = make_labels_config(labels)
+    template['rules'] = make_rules(labels)
+    template['lgtm_add'] = {'issue': ['approved'], 'pull_request': ['approved']}
+    local = make_labels_config(labels // 10)
+    local['rules'] = make_rules(labels // 10)
+    args = (template, local)
+    return (lambda: args), event.merge_config
+
+
+@benchmark('config.Config', labels=(10, 1000, 5000))
+def bench_config(labels):
+    """Compile a configuration with many labels and rules."""
+
+    config = make_labels_config(labels)
+    config['rules'] = make_rules(labels)
+    args = (config,)
+    return (lambda: args), label_config.Config
+
+
+def measure(prepare, call, min_time, min_rounds=5):
+    """Time calls until `min_time` seconds are spent, and get the median and fastest call."""
+
+    times = []
+    total = 0.0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while total < min_time or len(times) < min_rounds:
+            args = prepare()
+            start = time.perf_counter()
+            call(*args)
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+            total += elapsed
+    return statistics.median(times), min(times)
+
+
+def format_time(seconds):
+    """Format a duration."""
+
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return f'{seconds * scale:.2f}{unit}'
+    return f'{seconds * 1e9:.0f}ns'
+
+
+def load_baseline(path):
+    """Load the saved baseline."""
+
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)['results']
+
+
+def save_baseline(path, results):
+    """Save results as the baseline, keeping saved results for benchmarks that were not run."""
+
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'python': platform.python_version(), 'results': baseline}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main():
+    """Run the microbenchmarks."""
+
+    parser = argparse.ArgumentParser(prog='benchmarks.micro', description='Run Label Bot microbenchmarks.')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name matches this regular expression.')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds to spend timing each benchmark.')
+    parser.add_argument('--baseline', default=BASELINE, help='File the baseline is stored in.')
+    parser.add_argument('--save', action='store_true', help='Save the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent slower that counts as a regression.')
+    args = parser.parse_args()
+
+    pattern = re.compile(args.filter)
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+
+    print(f'{"Benchmark":60s} {"Median":>10s} {"Fastest":>10s} {"Baseline":>10s} {"Change":>8s}')
+    for name, factory in BENCHMARKS:
+        if not pattern.search(name):
+            continue
+        median, fastest = measure(*factory(), args.min_time)
+        results[name] = median
+
+        previous = baseline.get(name)
+        if previous is None:
+            compare = f'{"-":>10s} {"-":>8s}'
+        else:
+            change = (median - previous) / previous * 100
+            compare = f'{format_time(previous):>10s} {change:+7.1f}%'
+            if change > args.threshold:
+                regressions.append(name)
+                compare += '  REGRESSION'
+        print(f'{name:60s} {format_time(median):>10s} {format_time(fastest):>10s} {compare}')
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f'\nSaved baseline to {args.baseline}')
+    elif regressions:
+        print(f'\n{len(regressions)} benchmark(s) regressed by more than {args.threshold}%')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,83 +1,374 @@
 """Main."""
 import asyncio
-import aiohttp
+import contextlib
+import functools
+import importlib
 import os
 import sys
-import cachetools
 import traceback
 from aiohttp import web
 from aiojobs.aiohttp import setup, spawn, get_scheduler_from_app
 from gidgethub import routing, sansio
-from gidgethub import aiohttp as gh_aiohttp
+from . import github
+from . import graphql
 from . import wip_labels
 from . import sync_labels
 from . import triage_labels
 from . import commands
+from . import config_cache
+from . import deliveries
+from . import http_cache
+from . import jobstore
+from . import metrics
+from . import offload
+from . import throttle
+from . import scheduler
 from . import util
-__version__ = '1.10.0'
+__version__ = '1.11.0'
 
 router = routing.Router()
 routes = web.RouteTableDef()
-cache = cachetools.LRUCache(maxsize=500)
+# Event types with at least one registered handler.
+EVENTS = set()
+cache = http_cache.open_cache()
 
-sem = asyncio.Semaphore(1)
+jobs = scheduler.KeyedScheduler()
+coalescer = scheduler.Coalescer()
+delivered = deliveries.Deliveries()
+# IDs of recorded jobs this process has accepted or claimed and not finished, whether queued or running.
+accepted = set()
 
 
-async def deferred_commands(event):
-    """Defer handling of commands in comments."""
+def _collect_jobs():
+    """Collect job counts."""
 
-    async with sem:
-        async with aiohttp.ClientSession() as session:
-            token = os.environ.get("GH_AUTH")
-            bot = os.environ.get("GH_BOT")
-            gh = gh_aiohttp.GitHubAPI(session, bot, oauth_token=token, cache=cache)
-            await asyncio.sleep(1)
-            async for cmd in commands.run(event, gh, bot):
-                if cmd.pending is not None:
-                    await cmd.pending(cmd.event, gh)
+    try:
+        jobs_scheduler = get_scheduler_from_app(app)
+    except (NameError, KeyError):
+        return {}
+    return {('active',): jobs_scheduler.active_count, ('pending',): jobs_scheduler.pending_count}
+
+
+def _collect_rate_limits():
+    """Collect the remaining rate limit of each bucket."""
+
+    return {
+        (throttler.name,): throttler.remaining
+        for throttler in throttle.throttlers()
+        if throttler.remaining is not None
+    }
+
+
+metrics.Gauge('labelbot_jobs', 'Jobs in the job scheduler.', ['state'], collect=_collect_jobs)
+metrics.Gauge(
+    'labelbot_github_rate_limit_remaining', 'Remaining GitHub API calls.', ['bucket'], collect=_collect_rate_limits
+)
+
+
+async def start_session(app):
+    """Create the shared HTTP session."""
+
+    app['session'] = github.create_session()
+
+
+async def close_session(app):
+    """Close the shared HTTP session."""
+
+    await app['session'].close()
+
+
+async def start_monitor(app):
+    """Start measuring event loop lag."""
+
+    interval = float(os.environ.get('GH_BOT_LAG_INTERVAL', metrics.DEFAULT_LAG_INTERVAL))
+    app['lag_monitor'] = asyncio.ensure_future(metrics.monitor_lag(interval))
+
+
+async def close_monitor(app):
+    """Stop measuring event loop lag and shut down the CPU bound work pools."""
+
+    app['lag_monitor'].cancel()
+    offload.pool.close()
+
+
+async def start_cache(app):
+    """Start maintaining the persistent HTTP cache, if there is one."""
+
+    app['cache_maintenance'] = None
+    if isinstance(cache, http_cache.HTTPCache):
+        interval = float(os.environ.get('GH_BOT_HTTP_CACHE_INTERVAL', http_cache.DEFAULT_INTERVAL))
+        app['cache_maintenance'] = asyncio.ensure_future(cache.maintain(interval))
+
+
+async def close_cache(app):
+    """Stop maintaining the persistent HTTP cache."""
+
+    if app['cache_maintenance'] is not None:
+        app['cache_maintenance'].cancel()
+
+
+def register(event_type, **kwargs):
+    """Register a webhook handler and remember the event type as handled."""
 
-                await get_scheduler_from_app(app).spawn(
-                    deferred_task(cmd.command, cmd.event, kwargs=cmd.kwargs)
+    EVENTS.add(event_type)
+    return router.register(event_type, **kwargs)
+
+
+async def get_github(app, data):
+    """Get a GitHub API object for the payload's installation that uses the application's shared session."""
+
+    return await github.installation_api(app['session'], data, cache=cache)
+
+
+async def start_queue(app):
+    """Open the durable job queue (if configured) and replay any unfinished jobs."""
+
+    app['queue'] = jobstore.open_store()
+    app['queue_reclaim'] = None
+    delivered.store = app['queue']
+    if app['queue'] is not None:
+        await replay(app, startup=True)
+        app['queue_reclaim'] = asyncio.ensure_future(reclaim(app))
+
+
+async def close_queue(app):
+    """Close the durable job queue."""
+
+    if app['queue_reclaim'] is not None:
+        app['queue_reclaim'].cancel()
+    if app['queue'] is not None:
+        app['queue'].close()
+
+
+async def reclaim(app):
+    """Periodically renew our leases and pick up jobs from workers that went away."""
+
+    while True:
+        await asyncio.sleep(app['queue'].lease / 2)
+        try:
+            app['queue'].renew(accepted)
+            await replay(app)
+            app['queue'].prune_deliveries(delivered.ttl)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
+
+async def replay(app, startup=False):
+    """Claim and spawn jobs from the durable queue."""
+
+    count = 0
+    for job in app['queue'].claim(startup=startup):
+        # Our own jobs are only claimed if renewing their lease came too late, and they are already spawned.
+        if job.id in accepted:
+            continue
+
+        accepted.add(job.id)
+        try:
+            if job.kind == 'commands':
+                event = sansio.Event(job.data, event=job.event, delivery_id=job.options.get('delivery_id'))
+                coro = deferred_commands(event, job=job.id)
+            else:
+                pending = job.options.get('pending')
+                event = util.Event(job.event, job.data, job.options.get('local_ref', False))
+                coro = deferred_task(
+                    resolve(job.task),
+                    event,
+                    kwargs=job.options['kwargs'],
+                    coalesce=job.options['coalesce'],
+                    pending=None if pending is None else resolve(pending),
+                    job=job.id
                 )
+            await get_scheduler_from_app(app).spawn(coro)
+            count += 1
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            accepted.discard(job.id)
+            app['queue'].ack(job.id)
+
+    if count:
+        print(f'QUEUE: Replaying {count} jobs')
+
+
+def resolve(name):
+    """Resolve a recorded task name to its function."""
 
+    module, name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
 
-async def deferred_task(function, event, kwargs=None):
-    """Defer the event work."""
+
+def record(kind, task, event_type, data, options):
+    """Record an accepted job in the durable queue, if there is one."""
+
+    queue = app.get('queue')
+    if queue is None:
+        return None
+    job = queue.add(kind, task, event_type, data, options)
+    accepted.add(job)
+    return job
+
+
+@contextlib.contextmanager
+def acknowledge(job):
+    """
+    Acknowledge the job once it is done.
+
+    Jobs that fail are still acknowledged so they are not replayed forever, but jobs that are
+    cancelled (such as on shutdown) stay in the queue to be replayed on the next start.
+    """
+
+    if job is None:
+        yield
+        return
+
+    try:
+        yield
+    except Exception:
+        app['queue'].ack(job)
+        raise
+    else:
+        app['queue'].ack(job)
+    finally:
+        # Once we stop renewing its lease, a cancelled job can be claimed and replayed.
+        accepted.discard(job)
+
+
+def deferred_commands(event, job=None):
+    """
+    Defer handling of commands in comments.
+
+    The job is recorded right away, and the returned coroutine is what should be spawned.
+    """
+
+    if job is None:
+        job = record('commands', None, event.event, event.data, {'delivery_id': event.delivery_id})
+
+    return _deferred_commands(event, job)
+
+
+async def _deferred_commands(event, job):
+    """Schedule handling of commands in comments."""
+
+    with acknowledge(job):
+        await jobs.run(scheduler.get_key(event.data), _commands(event))
+
+
+async def _commands(event):
+    """Handle commands in comments."""
+
+    bot = os.environ.get("GH_BOT")
+    gh = await get_github(app, event.data)
+    with metrics.TASK_SECONDS.time('commands'):
+        async for cmd in commands.run(event, gh, bot):
+            await get_scheduler_from_app(app).spawn(
+                deferred_task(cmd.command, cmd.event, kwargs=cmd.kwargs, pending=cmd.pending)
+            )
+
+
+def deferred_task(function, event, kwargs=None, coalesce=False, pending=None, job=None):
+    """
+    Defer the event work.
+
+    The job is recorded right away, and the returned coroutine is what should be spawned.
+    When `coalesce` is enabled, a burst of the same work for the same issue or pull request
+    collapses into one run of the newest event. If given, `pending` is run first to mark the
+    task as pending.
+    """
 
     if kwargs is None:
         kwargs = {}
 
-    async with sem:
-        async with aiohttp.ClientSession() as session:
-            token = os.environ.get("GH_AUTH")
-            bot = os.environ.get("GH_BOT")
-            gh = gh_aiohttp.GitHubAPI(session, bot, oauth_token=token, cache=cache)
+    if job is None:
+        job = record(
+            'task',
+            f'{function.__module__}.{function.__qualname__}',
+            event.event,
+            event.data,
+            {
+                'local_ref': event.local_ref,
+                'kwargs': kwargs,
+                'coalesce': coalesce,
+                'pending': None if pending is None else f'{pending.__module__}.{pending.__qualname__}'
+            }
+        )
+
+    return _deferred_task(function, event, kwargs, coalesce, pending, job)
 
-            # If we need to make sure the task is working with live issue labels, turn off quick labels.
-            await asyncio.sleep(1)
-            config = await event.get_config(gh)
-            await function(event, gh, config, **kwargs)
 
+async def _deferred_task(function, event, kwargs, coalesce, pending, job):
+    """Schedule the event work."""
 
-@router.register("pull_request", action="labeled")
-@router.register("pull_request", action="unlabeled")
+    with acknowledge(job):
+        await _schedule_task(function, event, kwargs, coalesce, pending)
+
+
+async def _schedule_task(function, event, kwargs, coalesce, pending):
+    """Run the event work in order with other work for the same target."""
+
+    if not coalesce:
+        await jobs.run(event.key, _task(function, event, kwargs, pending))
+        return
+
+    key = event.key + (f'{function.__module__}.{function.__name__}',)
+    token = coalescer.claim(key)
+    try:
+        if await coalescer.wait(key, token):
+            current = functools.partial(coalescer.is_current, key, token)
+            await jobs.run(event.key, _task(function, event, kwargs, pending, current))
+        else:
+            print(f'COALESCE: Skipping superseded {key[2]} for {event.full_name}#{event.number}')
+    finally:
+        coalescer.release(key, token)
+
+
+async def _task(function, event, kwargs, pending=None, current=None):
+    """Run the event work."""
+
+    # Newer work for the same target may have arrived while we were queued.
+    if current is not None and not current():
+        print(f'COALESCE: Skipping superseded {function.__name__} for {event.full_name}#{event.number}')
+        return
+
+    gh = await get_github(app, event.data)
+    if function is commands.run_all_pull_actions and graphql.enabled():
+        await graphql.prefetch_pull_request(event, gh)
+    if pending is not None:
+        await pending(event, gh)
+    # Syncing skips configurations it has already synced, so it must not be handed a stale template.
+    config = await event.get_config(gh, fresh=function is sync_labels.run)
+    await function(event, gh, config, **kwargs)
+
+
+@register("pull_request", action="labeled")
+@register("pull_request", action="unlabeled")
+@metrics.timed(metrics.HANDLER_SECONDS, 'pull_label_events')
 async def pull_label_events(event, gh, request, *args, **kwargs):
     """
     Handle pull label events.
 
     These types of events just require us to handle: WIP.
+
+    Label changes made by the bot itself come in bursts (one event per label). If the WIP status
+    was already set from the labels the event reports, the event is skipped, otherwise the burst
+    is collapsed into a single WIP run. Label changes made by anyone else are always handled.
     """
 
+    sender = event.data['sender']['login']
     event = util.Event(event.event, event.data)
     if event.state != "open":
         return
 
-    await spawn(request, deferred_task(wip_labels.run, event))
+    if sender.lower() == os.environ.get("GH_BOT", "").lower():
+        if wip_labels.is_evaluated(event):
+            return
+        await spawn(request, deferred_task(wip_labels.run, event, coalesce=True))
+    else:
+        await spawn(request, deferred_task(wip_labels.run, event))
 
 
-@router.register("pull_request", action="synchronize")
-@router.register("pull_request", action="reopened")
-@router.register("pull_request", action="opened")
+@register("pull_request", action="synchronize")
+@register("pull_request", action="reopened")
+@register("pull_request", action="opened")
+@metrics.timed(metrics.HANDLER_SECONDS, 'pull_sync_events')
 async def pull_sync_events(event, gh, request, *args, **kwargs):
     """
     Handle any event that requires us to be aware of file changes.
@@ -89,10 +380,11 @@ async def pull_sync_events(event, gh, request, *args, **kwargs):
     if event.state != "open":
         return
 
-    await spawn(request, deferred_task(commands.run_all_pull_actions, event))
+    await spawn(request, deferred_task(commands.run_all_pull_actions, event, coalesce=True))
 
 
-@router.register("issues", action="opened")
+@register("issues", action="opened")
+@metrics.timed(metrics.HANDLER_SECONDS, 'issues_open_events')
 async def issues_open_events(event, gh, request, *args, **kwargs):
     """
     Handle issues open events.
@@ -104,26 +396,37 @@ async def issues_open_events(event, gh, request, *args, **kwargs):
     await spawn(request, deferred_task(triage_labels.run, event))
 
 
-@router.register('push')
+@register('push')
+@metrics.timed(metrics.HANDLER_SECONDS, 'push')
 async def push(event, gh, request, *args, **kwargs):
     """
     Handle push events on master.
 
     When pushing to master, we want to resync the labels with the latest config file.
+    Pushes that don't change the config file only resync if a template it uses has changed.
+
+    Any push (to any branch or tag) drops the cached files it changed, be they configuration
+    files or templates other repositories use.
     """
 
+    config_cache.cache.invalidate(
+        event.data['repository']['full_name'],
+        ref=event.data['ref'].split('/', 2)[-1],
+        paths=sync_labels.get_changed_paths(event.data)
+    )
+
     if 'refs/heads/' + event.data['repository']['default_branch'] != event.data['ref']:
         return
 
+    # The sync itself is skipped if the configuration (including any template) hasn't changed since the last one.
     event = util.Event(event.event, event.data)
-    await asyncio.sleep(1)
-    await sync_labels.pending(event, gh)
     await spawn(request, deferred_task(sync_labels.run, event))
 
 
-@router.register("issues", action="opened")
-@router.register("pull_request", action="opened")
-@router.register('issue_comment', action="created")
+@register("issues", action="opened")
+@register("pull_request", action="opened")
+@register('issue_comment', action="created")
+@metrics.timed(metrics.HANDLER_SECONDS, 'issue_comment_created')
 async def issue_comment_created(event, gh, request, *args, **kwargs):
     """
     Handle issue comment created.
@@ -138,6 +441,10 @@ async def issue_comment_created(event, gh, request, *args, **kwargs):
     if not event.data[etype]['author_association'] in ('COLLABORATOR', 'OWNER'):
         return
 
+    # Most comments don't mention the bot, so there is nothing to queue.
+    if not commands.has_command(event.data[etype].get('body'), os.environ.get("GH_BOT")):
+        return
+
     await spawn(request, deferred_commands(event))
 
 
@@ -146,24 +453,36 @@ async def main(request):
     """Handle requests."""
 
     try:
+        # Drop events we have no handler for before reading or parsing anything.
+        event_type = request.headers.get('X-GitHub-Event')
+        if event_type not in EVENTS and event_type != 'ping':
+            return web.Response(status=200)
+
         # Get payload
         payload = await request.read()
 
         # Get authentication
         secret = os.environ.get("GH_SECRET")
-        token = os.environ.get("GH_AUTH")
-        bot = os.environ.get("GH_BOT")
         event = sansio.Event.from_http(request.headers, payload, secret=secret)
 
         # Handle ping
         if event.event == "ping":
             return web.Response(status=200)
 
-        # Handle the event
-        async with aiohttp.ClientSession() as session:
-            gh = gh_aiohttp.GitHubAPI(session, bot, oauth_token=token, cache=cache)
+        # Drop redeliveries of events we've already handled.
+        if delivered.is_duplicate(event.delivery_id):
+            print(f'DELIVERY: Dropping duplicate {event.delivery_id} ({delivered.duplicates} total)')
+            metrics.DUPLICATE_DELIVERIES.inc()
+            return web.Response(status=200)
 
-            await router.dispatch(event, gh, request)
+        # Handlers only queue work, all GitHub API calls happen in the deferred jobs.
+        # If queuing fails, forget the delivery so a redelivery can try again.
+        delivered.add(event.delivery_id)
+        try:
+            await router.dispatch(event, None, request)
+        except Exception:
+            delivered.discard(event.delivery_id)
+            raise
 
         return web.Response(status=200)
     except Exception:
@@ -171,10 +490,34 @@ async def main(request):
         return web.Response(status=500)
 
 
+@routes.get("/metrics")
+async def metrics_report(request):
+    """Report metrics in the Prometheus text format."""
+
+    token = os.environ.get("GH_BOT_METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return web.Response(status=401)
+
+    return web.Response(
+        body=metrics.render().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
 if __name__ == "__main__":
     app = web.Application()
     app.add_routes(routes)
+    app.on_startup.append(start_session)
+    app.on_startup.append(start_monitor)
+    app.on_startup.append(start_cache)
     setup(app)
+    # Registered after the job scheduler so it exists when jobs are replayed,
+    # and so the queue and session outlive any jobs being closed.
+    app.on_startup.append(start_queue)
+    app.on_cleanup.append(close_queue)
+    app.on_cleanup.append(close_session)
+    app.on_cleanup.append(close_monitor)
+    app.on_cleanup.append(close_cache)
 
     port = os.environ.get("PORT")
     if port is not None:
@@ -1,16 +1,17 @@
 """Looks good to me command."""
 import traceback
 import sys
+from . import metrics
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'add_remove')
 async def run(event, gh, config, labels=None, remove=False, **kwargs):
     """Run the task."""
 
     print(f'ADD/REMOVE: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('labels')
 
         if not labels:
             return
@@ -32,13 +33,12 @@ async def run(event, gh, config, labels=None, remove=False, **kwargs):
 async def add_remove(event, gh, config, labels, remove_mode):
     """Remove specified labels, and set desired labels if specified."""
 
-    label_list = set([name['name'].lower() for name in config.get('labels', [])])
     labels = {label.lower(): label for label in labels}
 
     # Remove labels not currently tracked
     delete = []
     for label in labels.keys():
-        if label not in label_list:
+        if label not in config.label_names:
             delete.append(label)
     for label in delete:
         del labels[label]
@@ -0,0 +1,98 @@
+"""GitHub App authentication."""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+import cachetools
+from gidgethub import apps
+
+# Refresh installation tokens this many seconds before they expire (they last an hour).
+DEFAULT_REFRESH_MARGIN = 300
+DEFAULT_MAXSIZE = 1024
+
+
+def get_app_id():
+    """Get the GitHub App ID, if the bot is authenticating as an app."""
+
+    return os.environ.get('GH_APP_ID')
+
+
+def get_private_key():
+    """Get the GitHub App's private key, allowing new lines to be escaped (as in a single line environment variable)."""
+
+    return os.environ.get('GH_APP_PRIVATE_KEY', '').replace('\\n', '\n')
+
+
+def enabled():
+    """Check if the bot is authenticating as a GitHub App."""
+
+    return bool(get_app_id() and get_private_key())
+
+
+def parse_time(value):
+    """Parse a GitHub timestamp."""
+
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+
+class TokenCache:
+    """
+    Cache installation access tokens and refresh them before they expire.
+
+    Payloads say which installation they came from. The installation of each repository is
+    remembered so events built from partial payloads (like those of commands) can still find it.
+    Only one refresh per installation is in flight at a time, and everyone waiting on it shares it.
+    """
+
+    def __init__(self, refresh_margin=None, maxsize=DEFAULT_MAXSIZE):
+        """Initialize."""
+
+        if refresh_margin is None:
+            refresh_margin = os.environ.get('GH_APP_TOKEN_REFRESH', DEFAULT_REFRESH_MARGIN)
+
+        self.refresh_margin = float(refresh_margin)
+        self._tokens = {}
+        self._refreshing = {}
+        self._installations = cachetools.LRUCache(maxsize=maxsize)
+
+    def get_installation(self, data):
+        """Get the ID of the installation a payload belongs to."""
+
+        full_name = data.get('repository', {}).get('full_name')
+        installation = data.get('installation', {}).get('id')
+        if installation is None:
+            return self._installations.get(full_name)
+        if full_name is not None:
+            self._installations[full_name] = installation
+        return installation
+
+    async def get(self, gh, installation):
+        """Get a token for the installation, requesting a new one with `gh` if needed."""
+
+        entry = self._tokens.get(installation)
+        if entry is not None and entry[1] - time.time() > self.refresh_margin:
+            return entry[0]
+
+        task = self._refreshing.get(installation)
+        if task is None:
+            task = self._refreshing[installation] = asyncio.ensure_future(self._refresh(gh, installation))
+            task.add_done_callback(lambda t: self._refreshing.pop(installation, None))
+
+        # Don't let one waiter being cancelled cancel the refresh for everyone.
+        return await asyncio.shield(task)
+
+    async def _refresh(self, gh, installation):
+        """Request a new token for the installation."""
+
+        print(f'AUTH: Refreshing the token of installation {installation}')
+        result = await apps.get_installation_access_token(
+            gh,
+            installation_id=str(installation),
+            app_id=get_app_id(),
+            private_key=get_private_key()
+        )
+        self._tokens[installation] = (result['token'], parse_time(result['expires_at']))
+        return result['token']
+
+
+tokens = TokenCache()
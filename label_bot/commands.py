@@ -1,7 +1,9 @@
 """Handler of commands via issue comments/bodies."""
 import asyncio
 import re
-from bs4 import BeautifulSoup
+import sys
+import traceback
+from html.parser import HTMLParser
 from . import wip_labels
 from . import wildcard_labels
 from . import sync_labels
@@ -9,6 +11,9 @@ from . import triage_labels
 from . import review_labels
 from . import lgtm_labels
 from . import add_remove_labels
+from . import config_cache
+from . import graphql
+from . import offload
 from . import util
 from collections import namedtuple
 import gidgethub
@@ -32,16 +37,123 @@ RE_COMMANDS = re.compile(
     re.I
 )
 
+# Words that can start a command, used to cheaply rule out comments before parsing them.
+RE_KEYWORDS = r'(?:lgtm|add|remove|retrigger|sync)'
+
 
 class Command(namedtuple('Command', ['command', 'event', 'pending', 'live', 'kwargs'])):
     """Command."""
 
 
+class MentionParser(HTMLParser):
+    """
+    Collect the text that directly follows each mention of the bot in a comment's HTML.
+
+    Mentions inside code, preformatted text, and quotes are ignored.
+    """
+
+    IGNORE = frozenset(['code', 'pre', 'blockquote'])
+
+    def __init__(self, bot):
+        """Initialize."""
+
+        super().__init__(convert_charrefs=True)
+        self.mention = f'@{bot}'
+        self.href = f'/{bot}'
+        self.ignored = 0
+        self.anchor = None
+        self.sibling = None
+        self.found = []
+
+    def flush(self):
+        """Finish the text that follows a mention."""
+
+        if self.sibling is not None:
+            self.found.append(''.join(self.sibling))
+            self.sibling = None
+
+    def handle_starttag(self, tag, attrs):
+        """Handle start tag."""
+
+        self.flush()
+        if tag in self.IGNORE:
+            self.ignored += 1
+        elif tag == 'a' and not self.ignored and self.anchor is None:
+            attrs = dict(attrs)
+            if (
+                'user-mention' in (attrs.get('class') or '').split() and
+                (attrs.get('href') or '').endswith(self.href)
+            ):
+                self.anchor = []
+
+    def handle_endtag(self, tag):
+        """Handle end tag."""
+
+        self.flush()
+        if tag in self.IGNORE:
+            if self.ignored:
+                self.ignored -= 1
+        elif tag == 'a' and self.anchor is not None:
+            if self.mention in ''.join(self.anchor):
+                self.sibling = []
+            self.anchor = None
+
+    def handle_data(self, data):
+        """Handle text."""
+
+        if self.anchor is not None:
+            self.anchor.append(data)
+        elif self.sibling is not None:
+            self.sibling.append(data)
+
+    def handle_comment(self, data):
+        """Handle comment."""
+
+        self.flush()
+
+    def close(self):
+        """Finish parsing."""
+
+        super().close()
+        self.flush()
+
+
+def new_payload(event, **kwargs):
+    """Start a payload for a command's event, keeping the repository and installation of the original."""
+
+    payload = {'repository': event.data['repository']}
+    if 'installation' in event.data:
+        payload['installation'] = event.data['installation']
+    payload.update(kwargs)
+    return payload
+
+
+def has_command(body, bot):
+    """
+    Check if the comment's raw Markdown could contain a command for the bot.
+
+    This is a cheap check done before fetching and parsing the comment's HTML. It can pass for
+    comments that have no commands (such as a mention in a code block), but never fails for
+    comments that do.
+    """
+
+    if not body or not bot:
+        return False
+    return re.search(rf'@{re.escape(bot)}\s+{RE_KEYWORDS}', body, re.I) is not None
+
+
 async def get_issue_payload(gh, event):
     """Get the issue payload."""
 
-    await asyncio.sleep(1)
-    payload = {'repository': event.data['repository']}
+    payload = new_payload(event)
+    if graphql.enabled():
+        try:
+            result = await graphql.get_issue_payload(gh, event, payload)
+            if result is not None:
+                return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
     issue = await gh.getitem(event.data['comment']['issue_url'])
     event_type = 'issues'
     key = 'issue'
@@ -82,11 +194,12 @@ async def command_retrigger(event, action, gh, local_ref=False):
 async def command_sync(event, gh):
     """Handle sync command."""
 
-    await asyncio.sleep(1)
     event_type = 'push'
     branch = await gh.getitem(event.data['repository']['branches_url'], {'branch': event.data['default_branch']})
-    payload = {'repository': event.data['repository'], 'after': branch['commit']['sha']}
-    return Command(sync_labels.run, util.Event(event_type, payload), sync_labels.pending, False, {})
+    payload = new_payload(event, after=branch['commit']['sha'])
+    # A requested sync always runs against the latest configuration, even if nothing seems to have changed.
+    config_cache.cache.invalidate(event.data['repository']['full_name'])
+    return Command(sync_labels.run, util.Event(event_type, payload), None, False, {'force': True})
 
 
 async def command_lgtm(event, gh):
@@ -98,7 +211,6 @@ async def command_lgtm(event, gh):
     ):
         return None
 
-    await asyncio.sleep(1)
     if 'comment' in event.data:
         event_type, payload = await get_issue_payload(gh, event)
     else:
@@ -122,7 +234,6 @@ async def command_add_remove(event, gh, labels, remove=False):
         'remove': remove
     }
 
-    await asyncio.sleep(1)
     if 'comment' in event.data:
         event_type, payload = await get_issue_payload(gh, event)
     else:
@@ -133,15 +244,26 @@ async def command_add_remove(event, gh, labels, remove=False):
 
 
 async def run_all_pull_actions(event, gh, config, **kwargs):
-    """Run all label specific actions."""
-
-    await wip_labels.run(event, gh, config)
-    await asyncio.sleep(1)
-    await review_labels.run(event, gh, config)
-    await asyncio.sleep(1)
-    await wildcard_labels.pending(event, gh)
-    await asyncio.sleep(1)
-    await wildcard_labels.run(event, gh, config)
+    """
+    Run all label specific actions.
+
+    The issue labels are read once and shared by every task, and the net change is written back
+    at the end. WIP runs last so its status reflects the labels the other tasks leave behind, which
+    lets the label events caused by our own changes be skipped. If reading or writing the labels
+    fails, every task is marked as failed.
+    """
+
+    try:
+        async with event.stage_issue_labels(gh):
+            await review_labels.run(event, gh, config)
+            await wildcard_labels.pending(event, gh)
+            await wildcard_labels.run(event, gh, config)
+            await wip_labels.run(event, gh, config)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        wip_labels.evaluated.pop(event.key, None)
+        for context in ('labels/wip', 'labels/review', 'labels/auto-labels'):
+            await event.set_status(gh, util.EVT_FAILURE, context, 'Failed to complete task')
 
 
 async def react_to_command(event, gh):
@@ -161,15 +283,40 @@ async def react_to_command(event, gh):
     await gh.post(url, url_values, data={'content': 'eyes'}, accept=util.REACTION_HEADER)
 
 
+def find_mentions(body_html, bot):
+    """Find the text that follows each mention of the bot in a comment's HTML."""
+
+    parser = MentionParser(bot)
+    parser.feed(body_html)
+    parser.close()
+    return parser.found
+
+
+def find_commands(body_html, bot, mentions=None):
+    """Find the commands that follow mentions of the bot in a comment's HTML."""
+
+    if mentions is None:
+        mentions = find_mentions(body_html, bot)
+
+    for text in mentions:
+        m = RE_COMMANDS.match(text)
+        if m is not None:
+            yield m
+
+
 async def run(event, gh, bot):
     """Handle commands."""
 
+    etype = EVENT_MAP[event.event]
+
+    # Most comments don't mention the bot, so don't fetch and parse them.
+    if not has_command(event.data[etype].get('body'), bot):
+        return
+
     print(f'COMMAND: {event.data["repository"]["full_name"]}')
 
     reacted = False
 
-    etype = EVENT_MAP[event.event]
-
     # Sometimes we are not able to get the message, maybe it isn't available yet?
     # Attempt no more than three times. If we can't get it after that, raise issue.
     retry = 3
@@ -187,17 +334,10 @@ async def run(event, gh, bot):
                 print('RETRY: Out of retries, cannot retrieve issue comments.')
                 raise
 
-    soup = BeautifulSoup(comment['body_html'], 'html.parser')
-
-    for el in soup.select(f'a.user-mention:contains("@{bot}")[href$="/{bot}"]'):
-
-        sib = el.next_sibling
-        if not isinstance(sib, str):
-            continue
-
-        m = RE_COMMANDS.match(sib)
-        if m is None:
-            continue
+    body_html = comment['body_html']
+    # Long comments are parsed off the event loop.
+    mentions = await offload.pool.run('html', len(body_html), find_mentions, body_html, bot)
+    for m in find_commands(body_html, bot, mentions):
 
         if etype == 'comment' and m.group('retrigger'):
             cmd = await command_retrigger(event, m.group('retrigger_task'), gh, local_ref=bool(m.group('local')))
@@ -0,0 +1,183 @@
+"""Compiled label configuration."""
+import traceback
+import sys
+import types
+import cachetools
+from . import config_cache
+from . import review_labels
+from . import sync_labels
+from . import triage_labels
+from . import util
+from . import wildcard_labels
+from . import wip_labels
+
+DEFAULT_MAXSIZE = 256
+
+# Compiled configurations, by the identity of the cached local and template files they were built from.
+compiled = cachetools.LRUCache(maxsize=DEFAULT_MAXSIZE)
+
+
+class ConfigError(Exception):
+    """Configuration could not be loaded or an option is invalid."""
+
+
+def _lowered(names):
+    """Get the lowered names."""
+
+    return frozenset([name.lower() for name in names])
+
+
+def _by_lowered(names):
+    """Map lowered names to the names."""
+
+    return types.MappingProxyType({name.lower(): name for name in names})
+
+
+class Config:
+    """
+    Label configuration compiled once, when it is loaded, and shared by every task.
+
+    Options are validated and turned into the structures the tasks work with: lowered sets and maps
+    of label names, resolved colors, the validated labels, and the compiled wildcard rules. If the
+    configuration could not be loaded, `error` holds the reason. If a group of options is invalid,
+    the reason is kept in `invalid` by the group's name, so only the tasks using them fail.
+    """
+
+    __slots__ = (
+        'data', 'error', 'invalid', 'fingerprint',
+        'wip',
+        'review_add', 'review_skip', 'review_remove',
+        'triage_add', 'triage_skip', 'triage_remove',
+        'lgtm_add_issue', 'lgtm_add_pull_request', 'lgtm_remove',
+        'colors', 'labels', 'ignores', 'label_names', 'delete_labels',
+        'flags', 'rules'
+    )
+
+    def __init__(self, data, error=None):
+        """Initialize."""
+
+        set_attr = super().__setattr__
+        set_attr('data', types.MappingProxyType({}) if error else data)
+        set_attr('error', error)
+        set_attr('invalid', {})
+        set_attr('fingerprint', None if error else util.fingerprint(data))
+
+        data = self.data
+        self._compile('wip', self._compile_wip, data)
+        self._compile('review', self._compile_review, data)
+        self._compile('triage', self._compile_triage, data)
+        self._compile('lgtm', self._compile_lgtm, data)
+        self._compile('labels', self._compile_labels, data)
+        self._compile('rules', self._compile_rules, data)
+        set_attr('invalid', types.MappingProxyType(self.invalid))
+
+    @classmethod
+    def from_error(cls, error):
+        """Create a configuration that failed to load."""
+
+        return cls(None, error=error)
+
+    def __setattr__(self, name, value):
+        """Prevent changes."""
+
+        raise AttributeError(f"'{self.__class__.__name__}' object is read-only")
+
+    def _compile(self, name, function, data):
+        """Compile a group of options, remembering why if they are invalid."""
+
+        try:
+            for key, value in function(data).items():
+                super().__setattr__(key, value)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            self.invalid[name] = str(traceback.format_exc())
+            for key in function(types.MappingProxyType({})):
+                super().__setattr__(key, None)
+
+    @staticmethod
+    def _compile_wip(data):
+        """Compile the WIP options."""
+
+        return {'wip': _lowered(data.get('wip', wip_labels.DEFAULT))}
+
+    @staticmethod
+    def _compile_review(data):
+        """Compile the review options."""
+
+        review_label = data.get('review_label', review_labels.DEFAULT)
+        return {
+            'review_add': _by_lowered([review_label] if review_label else []),
+            'review_skip': _lowered(data.get('review_skip', review_labels.DEFAULT_SKIP)),
+            'review_remove': _by_lowered(data.get('review_remove', review_labels.DEFAULT_REMOVE))
+        }
+
+    @staticmethod
+    def _compile_triage(data):
+        """Compile the triage options."""
+
+        triage_label = data.get('triage_label', triage_labels.DEFAULT)
+        return {
+            'triage_add': _by_lowered([triage_label] if triage_label else []),
+            'triage_skip': _lowered(data.get('triage_skip', triage_labels.DEFAULT_SKIP)),
+            'triage_remove': _by_lowered(data.get('triage_remove', triage_labels.DEFAULT_REMOVE))
+        }
+
+    @staticmethod
+    def _compile_lgtm(data):
+        """Compile the LGTM options."""
+
+        return {
+            'lgtm_add_issue': _by_lowered(data.get('lgtm_add_issue', [])),
+            'lgtm_add_pull_request': _by_lowered(data.get('lgtm_add_pull_request', [])),
+            'lgtm_remove': _by_lowered(data.get('lgtm_remove', []))
+        }
+
+    @staticmethod
+    def _compile_labels(data):
+        """Compile the label options."""
+
+        colors = sync_labels._parse_colors(data)
+        labels, ignores = sync_labels._parse_labels(data, colors)
+        return {
+            'colors': types.MappingProxyType(colors),
+            'labels': config_cache.freeze(labels),
+            'ignores': frozenset(ignores),
+            'label_names': _lowered([value['name'] for value in labels]),
+            'delete_labels': data.get('delete_labels', False)
+        }
+
+    @staticmethod
+    def _compile_rules(data):
+        """Compile the wildcard options."""
+
+        flags = wildcard_labels.get_flags(data)
+        return {
+            'flags': flags,
+            'rules': tuple(wildcard_labels.compile_rules(data.get('rules', []), flags))
+        }
+
+    def check(self, *names):
+        """Raise an error if the configuration failed to load or any of the named option groups are invalid."""
+
+        if self.error:
+            raise ConfigError(self.error)
+        for name in names:
+            if name in self.invalid:
+                raise ConfigError(self.invalid[name])
+
+
+def get_config(local, template, merge):
+    """
+    Get the compiled configuration for a cached local file and template.
+
+    Cached files are frozen and shared, so a configuration is only compiled again when one of
+    them was loaded again.
+    """
+
+    key = (id(local), id(template))
+    entry = compiled.get(key)
+    # The files are kept alive by the entry, so their ids can't have been reused.
+    if entry is None or entry[0] is not local or entry[1] is not template:
+        data = local if template is None else merge(template, local)
+        entry = compiled[key] = (local, template, Config(data))
+    return entry[2]
@@ -0,0 +1,176 @@
+"""Cache of parsed configuration files."""
+import asyncio
+import base64
+import os
+import sys
+import time
+import traceback
+import types
+import cachetools
+import yaml
+from . import offload
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+DEFAULT_MAXSIZE = 256
+DEFAULT_TTL = 300
+
+
+def freeze(value):
+    """Make a parsed YAML value read-only so it can be shared."""
+
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def parse(content):
+    """Parse a YAML file."""
+
+    return yaml.load(content, Loader=Loader)
+
+
+class Entry:
+    """Cached file entry."""
+
+    __slots__ = ('sha', 'value', 'checked')
+
+    def __init__(self, sha, value, checked):
+        """Initialize."""
+
+        self.sha = sha
+        self.value = value
+        self.checked = checked
+
+
+class ConfigCache:
+    """
+    Cache parsed configuration files by repository, path, and ref.
+
+    Entries remember the blob SHA they were parsed from. While an entry is fresh it is returned
+    without any API call. Once it goes stale, the file is requested again (which gidgethub revalidates
+    with its ETag), and the YAML is only parsed again if the blob SHA changed. Entries for a commit SHA
+    never change, so they never go stale.
+
+    Only one request per file is in flight at a time, and everyone waiting on the file shares it.
+    Parsed files are frozen (mappings become read-only and lists become tuples), so the same
+    object can be handed to every caller.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        """Initialize."""
+
+        if maxsize is None:
+            maxsize = os.environ.get('GH_BOT_CONFIG_CACHE_SIZE', DEFAULT_MAXSIZE)
+        if ttl is None:
+            ttl = os.environ.get('GH_BOT_CONFIG_TTL', DEFAULT_TTL)
+
+        self.ttl = float(ttl)
+        self._entries = cachetools.LRUCache(maxsize=int(maxsize))
+        self._loading = {}
+
+    async def load(self, gh, key, url, url_vars, immutable=False, background=False, fresh=False):
+        """
+        Load the parsed file.
+
+        With `background`, a stale entry is returned right away while it is revalidated in the
+        background. With `fresh`, the entry is revalidated even if it isn't stale yet (which is
+        one conditional request). The returned value is frozen and shared with the cache.
+        """
+
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and (immutable or (not fresh and now - entry.checked < self.ttl)):
+            return entry.value
+
+        task = self._loading.get(key)
+        if task is None:
+            task = self._start(gh, key, url, url_vars)
+
+        if entry is not None and background:
+            return entry.value
+
+        # Don't let one waiter being cancelled cancel the request for everyone.
+        return await asyncio.shield(task)
+
+    def _start(self, gh, key, url, url_vars):
+        """Start requesting the file."""
+
+        task = self._loading[key] = asyncio.ensure_future(self._fetch(gh, key, url, url_vars))
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key, task):
+        """Clean up after a request finishes."""
+
+        if self._loading.get(key) is task:
+            del self._loading[key]
+        if not task.cancelled() and task.exception() is not None:
+            print(f'CONFIG: Failed to load {key}')
+            traceback.print_exception(type(task.exception()), task.exception(), None, file=sys.stdout)
+
+    async def _fetch(self, gh, key, url, url_vars):
+        """Request the file and parse it if it changed."""
+
+        result = await gh.getitem(url, url_vars)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry.sha == result['sha']:
+            entry.checked = now
+            return entry.value
+
+        content = base64.b64decode(result['content']).decode('utf-8')
+        # Big files are parsed off the event loop. What comes back may be a copy, so it is frozen here.
+        value = freeze(await offload.pool.run('yaml', len(content), parse, content))
+        # The file may have been invalidated while it was requested, in which case the result
+        # could already be out of date and shouldn't be cached.
+        if self._loading.get(key) is asyncio.current_task():
+            self._entries[key] = Entry(result['sha'], value, now)
+        return value
+
+    def is_fresh(self, key, immutable=False):
+        """Check if the file is cached and doesn't need to be checked for changes yet."""
+
+        entry = self._entries.get(key)
+        return entry is not None and (immutable or time.time() - entry.checked < self.ttl)
+
+    async def seed(self, key, sha, content):
+        """Cache a file that was read some other way, parsing it only if it changed."""
+
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry.sha == sha:
+            entry.checked = now
+            return
+
+        value = freeze(await offload.pool.run('yaml', len(content), parse, content))
+        self._entries[key] = Entry(sha, value, now)
+
+    def invalidate(self, full_name, ref=None, paths=None):
+        """
+        Drop cached files from the given repository.
+
+        If `ref` is given, only files at that ref are dropped, and if `paths` is given, only files
+        with one of those paths.
+        """
+
+        def matches(key):
+            """Check if a cached file should be dropped."""
+
+            return (
+                key[0] == full_name and
+                (ref is None or key[2] == ref) and
+                (paths is None or key[1].strip('/') in paths)
+            )
+
+        for key in [key for key in self._entries.keys() if matches(key)]:
+            del self._entries[key]
+        for key in [key for key in self._loading.keys() if matches(key)]:
+            del self._loading[key]
+
+
+cache = ConfigCache()
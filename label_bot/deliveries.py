@@ -0,0 +1,64 @@
+"""Redelivered webhook detection."""
+import os
+import cachetools
+
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TTL = 86400
+
+
+class Deliveries:
+    """
+    Remember recent delivery IDs so redelivered webhooks can be dropped.
+
+    IDs are kept in a bounded in-memory cache for `ttl` seconds. If a durable job queue is
+    available, IDs are also kept there so they are shared between workers and survive restarts.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        """Initialize."""
+
+        if maxsize is None:
+            maxsize = os.environ.get('GH_BOT_DELIVERY_CACHE_SIZE', DEFAULT_MAXSIZE)
+        if ttl is None:
+            ttl = os.environ.get('GH_BOT_DELIVERY_TTL', DEFAULT_TTL)
+
+        self.ttl = float(ttl)
+        self.store = None
+        self.duplicates = 0
+        self._seen = cachetools.TTLCache(maxsize=int(maxsize), ttl=self.ttl)
+
+    def is_duplicate(self, delivery_id):
+        """Check if the delivery was already handled, counting it if it was."""
+
+        if not delivery_id:
+            return False
+
+        duplicate = delivery_id in self._seen
+        if not duplicate and self.store is not None:
+            duplicate = self.store.has_delivery(delivery_id, self.ttl)
+            if duplicate:
+                self._seen[delivery_id] = True
+
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
+
+    def add(self, delivery_id):
+        """Remember a delivery that was handled."""
+
+        if not delivery_id:
+            return
+
+        self._seen[delivery_id] = True
+        if self.store is not None:
+            self.store.add_delivery(delivery_id)
+
+    def discard(self, delivery_id):
+        """Forget a delivery that could not be handled."""
+
+        if not delivery_id:
+            return
+
+        self._seen.pop(delivery_id, None)
+        if self.store is not None:
+            self.store.remove_delivery(delivery_id)
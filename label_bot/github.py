@@ -0,0 +1,101 @@
+"""GitHub API access."""
+import os
+import aiohttp
+from gidgethub import aiohttp as gh_aiohttp
+from gidgethub import sansio
+from . import auth
+from . import metrics
+from . import throttle
+
+DEFAULT_CONN_LIMIT = 100
+DEFAULT_CONN_LIMIT_PER_HOST = 20
+DEFAULT_KEEPALIVE = 30.0
+DEFAULT_DNS_TTL = 300
+
+
+class GitHubAPI(gh_aiohttp.GitHubAPI):
+    """GitHub API that sends every call through a rate limit aware throttler."""
+
+    def __init__(self, *args, throttler=None, **kwargs):
+        """Initialize."""
+
+        super().__init__(*args, **kwargs)
+        self.throttler = throttle.Throttler() if throttler is None else throttler
+
+    async def _request(self, method, url, headers, body=b''):
+        """Make the request once the throttler allows it, retrying if GitHub asks us to back off."""
+
+        retries = self.throttler.retries
+        while True:
+            # GraphQL queries are reads, even though they are sent with POST.
+            await self.throttler.acquire('GET' if url.endswith('/graphql') else method)
+            status, response_headers, data = await super()._request(method, url, headers, body)
+            metrics.GITHUB_REQUESTS.inc(method, metrics.endpoint(url), str(status))
+            if method == 'GET':
+                metrics.GITHUB_CACHE.inc('hit' if status == 304 else 'miss')
+            retry_after = self.throttler.update(status, response_headers)
+            if retry_after is None or not retries:
+                return status, response_headers, data
+            retries -= 1
+            print(f'THROTTLE: {method} {url} asked to retry after {retry_after} seconds')
+
+
+def create_session():
+    """
+    Create the application's HTTP session.
+
+    The session is created once and shared by every request and job so connections
+    to the GitHub API are reused instead of doing a new TCP and TLS handshake each time.
+    """
+
+    connector = aiohttp.TCPConnector(
+        limit=int(os.environ.get('GH_BOT_CONN_LIMIT', DEFAULT_CONN_LIMIT)),
+        limit_per_host=int(os.environ.get('GH_BOT_CONN_LIMIT_PER_HOST', DEFAULT_CONN_LIMIT_PER_HOST)),
+        keepalive_timeout=float(os.environ.get('GH_BOT_KEEPALIVE', DEFAULT_KEEPALIVE)),
+        ttl_dns_cache=int(os.environ.get('GH_BOT_DNS_TTL', DEFAULT_DNS_TTL))
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def api(session, cache=None, token=None, throttler=None):
+    """Get a GitHub API object that uses the shared session and the token's shared throttler."""
+
+    if token is None:
+        token = os.environ.get("GH_AUTH")
+    return GitHubAPI(
+        session,
+        os.environ.get("GH_BOT"),
+        oauth_token=token,
+        cache=cache,
+        base_url=os.environ.get('GH_API_URL', sansio.DOMAIN),
+        throttler=throttle.get(token, 'token') if throttler is None else throttler
+    )
+
+
+async def installation_api(session, data, cache=None):
+    """
+    Get a GitHub API object for the installation a payload came from.
+
+    When the bot authenticates as a GitHub App, each installation has its own token and its own
+    rate limit, so each gets its own throttler. Otherwise, or if the installation isn't known,
+    the `GH_AUTH` token is used.
+    """
+
+    installation = auth.tokens.get_installation(data) if auth.enabled() else None
+    if installation is None:
+        return api(session, cache=cache)
+
+    # Tokens are requested as the app itself, which has a rate limit of its own.
+    app_gh = GitHubAPI(
+        session,
+        os.environ.get("GH_BOT"),
+        base_url=os.environ.get('GH_API_URL', sansio.DOMAIN),
+        throttler=throttle.get(('app',), 'app')
+    )
+    token = await auth.tokens.get(app_gh, installation)
+    return api(
+        session,
+        cache=cache,
+        token=token,
+        throttler=throttle.get(('installation', installation), f'installation-{installation}')
+    )
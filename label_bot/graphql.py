@@ -0,0 +1,179 @@
+"""Batched reads with the GitHub GraphQL API."""
+import os
+import sys
+import traceback
+from . import config_cache
+from . import util
+
+# Page size of labels and changed files.
+PAGE_SIZE = 100
+
+PULL_REQUEST_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!, $expression: String!, $config: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    config: object(expression: $expression) @include(if: $config) {
+      ... on Blob { oid text isTruncated }
+    }
+    pullRequest(number: $number) {
+      state
+      labels(first: %(page)d) { nodes { name } pageInfo { hasNextPage } }
+      files(first: %(page)d) { nodes { path changeType } pageInfo { hasNextPage endCursor } }
+    }
+  }
+}
+''' % {'page': PAGE_SIZE}
+
+FILES_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      files(first: %(page)d, after: $after) { nodes { path changeType } pageInfo { hasNextPage endCursor } }
+    }
+  }
+}
+''' % {'page': PAGE_SIZE}
+
+ISSUE_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    issueOrPullRequest(number: $number) {
+      __typename
+      ... on Issue {
+        number
+        state
+        labels(first: %(page)d) { nodes { name } pageInfo { hasNextPage } }
+      }
+      ... on PullRequest {
+        number
+        state
+        headRefOid
+        headRefName
+        headRepositoryOwner { login }
+        baseRefOid
+        baseRefName
+        baseRepository { owner { login } }
+        labels(first: %(page)d) { nodes { name } pageInfo { hasNextPage } }
+      }
+    }
+  }
+}
+''' % {'page': PAGE_SIZE}
+
+
+def enabled():
+    """Check if reads should be batched with the GraphQL API."""
+
+    return os.environ.get('GH_BOT_GRAPHQL', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+async def query(gh, text, repository, **variables):
+    """Run a query against a repository."""
+
+    return await gh.graphql(
+        text,
+        endpoint=gh.base_url.rstrip('/') + '/graphql',
+        owner=repository['owner']['login'],
+        name=repository['name'],
+        **variables
+    )
+
+
+async def prefetch_pull_request(event, gh):
+    """
+    Read what running all the pull request tasks needs in one query.
+
+    The query gets the pull request's state, its labels, the first page of its changed files, and
+    the label configuration (if the cached one is stale). The labels and files are handed to the
+    event, and the configuration to the config cache, so the tasks don't have to ask for them again.
+    If the query fails, or something can't be taken from it, the tasks fall back to the REST API.
+    """
+
+    ref = event.sha if event.local_ref else event.default_branch
+    key = (event.full_name, util.CONFIG_PATH, ref)
+    try:
+        data = await query(
+            gh,
+            PULL_REQUEST_QUERY,
+            event.data['repository'],
+            number=int(event.number),
+            expression=f'{ref}:{util.CONFIG_PATH}',
+            config=not config_cache.cache.is_fresh(key, immutable=event.local_ref)
+        )
+        repository = data['repository']
+        pull_request = repository['pullRequest']
+
+        blob = repository.get('config')
+        if blob and blob.get('text') is not None and not blob['isTruncated']:
+            await config_cache.cache.seed(key, blob['oid'], blob['text'])
+
+        event.state = pull_request['state'].lower()
+
+        labels = pull_request['labels']
+        if not labels['pageInfo']['hasNextPage']:
+            event.prefetched_labels = [node['name'] for node in labels['nodes']]
+
+        event.prefetched_files = get_changed_files(event, gh, pull_request['files'])
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+
+
+async def get_changed_files(event, gh, page):
+    """
+    Get the changed files, starting from a page that was already read, and following its cursor.
+
+    GraphQL doesn't give the previous names of renamed files, so if a renamed file shows up,
+    `None` is yielded to tell the caller to list the files with the REST API instead.
+    """
+
+    while True:
+        for node in page['nodes']:
+            if node['changeType'] == 'RENAMED':
+                yield None
+                return
+            yield node['path']
+
+        if not page['pageInfo']['hasNextPage']:
+            return
+
+        data = await query(
+            gh,
+            FILES_QUERY,
+            event.data['repository'],
+            number=int(event.number),
+            after=page['pageInfo']['endCursor']
+        )
+        page = data['repository']['pullRequest']['files']
+
+
+async def get_issue_payload(gh, event, payload):
+    """
+    Get the issue or pull request a comment belongs to in one query, in the shape of a REST payload.
+
+    Returns `None` if the labels don't fit in one page.
+    """
+
+    repository = event.data['repository']
+    data = await query(gh, ISSUE_QUERY, repository, number=event.data['issue']['number'])
+    issue = data['repository']['issueOrPullRequest']
+    if issue['labels']['pageInfo']['hasNextPage']:
+        return None
+
+    item = {
+        'number': issue['number'],
+        # Merged pull requests are closed as far as REST is concerned.
+        'state': 'open' if issue['state'] == 'OPEN' else 'closed',
+        'labels': [{'name': node['name']} for node in issue['labels']['nodes']]
+    }
+
+    if issue['__typename'] != 'PullRequest':
+        item['url'] = event.data['comment']['issue_url']
+        payload['issue'] = item
+        return 'issues', payload
+
+    head_owner = (issue['headRepositoryOwner'] or {}).get('login', '')
+    base_owner = ((issue['baseRepository'] or {}).get('owner') or {}).get('login', '')
+    item['url'] = f"{repository['url']}/pulls/{issue['number']}"
+    item['head'] = {'sha': issue['headRefOid'], 'label': f"{head_owner}:{issue['headRefName']}"}
+    item['base'] = {'sha': issue['baseRefOid'], 'label': f"{base_owner}:{issue['baseRefName']}"}
+    payload['pull_request'] = item
+    return 'pull_request', payload
@@ -0,0 +1,283 @@
+"""Persistent cache for conditional GitHub API requests."""
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import traceback
+import zlib
+from collections.abc import MutableMapping
+import cachetools
+from . import metrics
+
+DEFAULT_MAXSIZE = 500
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 86400
+DEFAULT_INTERVAL = 60
+# Milliseconds a read or write on the event loop waits for another process to release the database.
+# A cache that is busy is treated as a miss, so it can't hold up everything else.
+BUSY_TIMEOUT = 50
+# Milliseconds expiry and eviction (which run off the event loop) wait for the database.
+MAINTENANCE_BUSY_TIMEOUT = 5000
+# How long an unused entry is kept, by the kind of resource it is. Zero means it is never stored.
+DEFAULT_TTLS = {
+    # Configuration files and templates are read over and over, and rarely change.
+    'contents': 7 * 86400,
+    'labels': 86400,
+    'files': 86400,
+    'branches': 3600,
+    'issues': 3600,
+    'pulls': 3600,
+    # A comment is only read once, when it is posted.
+    'comments': 0
+}
+
+# Bumped whenever the schema changes. It's only a cache, so a database of another version is just emptied.
+SCHEMA_VERSION = 1
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS entries (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        data BLOB NOT NULL,
+        more TEXT,
+        size INTEGER NOT NULL,
+        ttl REAL NOT NULL,
+        used REAL NOT NULL,
+        expires REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS entries_used ON entries (used)',
+    'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)'
+)
+
+
+def get_resource(url):
+    """Get the kind of resource a URL points to (the last named part of its endpoint)."""
+
+    names = [part for part in metrics.endpoint(url).split('/') if part and not part.startswith(':')]
+    return names[-1] if names else ''
+
+
+def get_ttls():
+    """Get the TTL of each kind of resource, with any overrides from `GH_BOT_HTTP_CACHE_TTL`."""
+
+    ttls = dict(DEFAULT_TTLS)
+    for item in os.environ.get('GH_BOT_HTTP_CACHE_TTL', '').split(','):
+        if '=' in item:
+            name, ttl = item.split('=', 1)
+            ttls[name.strip()] = float(ttl)
+    return ttls
+
+
+def is_busy(error):
+    """Check if a database error is because another connection holds the database."""
+
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def connect(path, busy_timeout):
+    """Open the database."""
+
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+    return db
+
+
+def open_cache():
+    """Open the persistent cache if one is configured, otherwise use an in-memory cache."""
+
+    path = os.environ.get('GH_BOT_HTTP_CACHE')
+    if not path:
+        return cachetools.LRUCache(maxsize=DEFAULT_MAXSIZE)
+    return HTTPCache(path)
+
+
+class HTTPCache(MutableMapping):
+    """
+    Keep GitHub API responses and their `ETag` and `Last-Modified` headers in SQLite.
+
+    This is the mapping gidgethub uses to make conditional requests: URLs map to
+    `(etag, last_modified, data, more)`. Entries are kept until they have gone unused for their
+    resource's TTL, and when the total size goes over `max_bytes`, the least recently used
+    entries are evicted. Several worker processes can share the same database file.
+
+    Reads and writes happen on the event loop, so they are kept to single indexed rows, and give up
+    quickly if another process holds the database. Dropping expired entries and evicting is left
+    to `maintain`, which runs them periodically in a thread, and early if the running estimate of
+    the size goes over `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=None, ttls=None):
+        """Initialize."""
+
+        if max_bytes is None:
+            max_bytes = os.environ.get('GH_BOT_HTTP_CACHE_SIZE', DEFAULT_MAX_BYTES)
+
+        self.max_bytes = int(max_bytes)
+        self.ttls = get_ttls() if ttls is None else ttls
+        # Only used by whatever runs `evict`, which is one thread at a time.
+        self._maintenance_db = connect(path, MAINTENANCE_BUSY_TIMEOUT)
+        self._setup(self._maintenance_db)
+        self._db = connect(path, BUSY_TIMEOUT)
+        # Estimated size of the cache. It's only exact after an eviction, as other processes write too.
+        self.size = self._get_size(self._maintenance_db)
+        self._evict_soon = None
+
+    @staticmethod
+    def _setup(db):
+        """Create the tables, replacing any left by another version of the cache."""
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                db.execute('DROP TABLE IF EXISTS entries')
+                for statement in SCHEMA:
+                    db.execute(statement)
+                db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _get_size(db):
+        """Get the total size of the cached responses."""
+
+        return db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def close(self):
+        """Close the database."""
+
+        self._db.close()
+        self._maintenance_db.close()
+
+    def get_ttl(self, url):
+        """Get how long an entry for the URL is kept while unused."""
+
+        return self.ttls.get(get_resource(url), self.ttls.get('default', DEFAULT_TTL))
+
+    def __getitem__(self, url):
+        """Get a cached response, marking it as used."""
+
+        now = time.time()
+        try:
+            row = self._db.execute(
+                'SELECT etag, last_modified, data, more, ttl FROM entries WHERE url = ? AND expires >= ?', (url, now)
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            row = None
+        if row is None:
+            raise KeyError(url)
+
+        etag, last_modified, data, more, ttl = row
+        try:
+            self._db.execute('UPDATE entries SET used = ?, expires = ? WHERE url = ?', (now, now + ttl, url))
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+        return etag, last_modified, json.loads(zlib.decompress(data).decode('utf-8')), more
+
+    def __setitem__(self, url, value):
+        """Cache a response, asking for an eviction if the cache seems too big."""
+
+        ttl = self.get_ttl(url)
+        if ttl <= 0:
+            return
+
+        etag, last_modified, data, more = value
+        blob = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        size = len(blob) + len(url) + len(etag or '') + len(last_modified or '') + len(more or '')
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        try:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries (url, etag, last_modified, data, more, size, ttl, used, expires) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, blob, more, size, ttl, now, now + ttl)
+            )
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            return
+
+        # A replaced entry's size isn't subtracted, so the estimate errs on the big side.
+        self.size += size
+        if self.size > self.max_bytes:
+            if self._evict_soon is not None:
+                self._evict_soon.set()
+            else:
+                # Nothing is maintaining the cache, so evict right away.
+                self.size = self.evict()
+
+    def __delitem__(self, url):
+        """Remove a cached response."""
+
+        if self._db.execute('DELETE FROM entries WHERE url = ?', (url,)).rowcount == 0:
+            raise KeyError(url)
+
+    def __iter__(self):
+        """Iterate the cached URLs."""
+
+        return iter([row[0] for row in self._db.execute('SELECT url FROM entries')])
+
+    def __len__(self):
+        """Get the number of cached responses."""
+
+        return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used ones until the cache fits in its size.
+
+        Returns the size of the cache afterwards. This blocks, so `maintain` runs it in a thread.
+        """
+
+        db = self._maintenance_db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+            total = self._get_size(db)
+            if total > self.max_bytes:
+                # Evict down to 90% so the next few inserts don't have to evict again.
+                excess = total - self.max_bytes * 0.9
+                urls = []
+                for url, size in db.execute('SELECT url, size FROM entries ORDER BY used'):
+                    urls.append((url,))
+                    total -= size
+                    excess -= size
+                    if excess <= 0:
+                        break
+                db.executemany('DELETE FROM entries WHERE url = ?', urls)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return total
+
+    async def maintain(self, interval=DEFAULT_INTERVAL):
+        """Evict every `interval` seconds, or sooner if the cache grows too big, in a thread."""
+
+        loop = asyncio.get_event_loop()
+        self._evict_soon = asyncio.Event()
+        try:
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._evict_soon.wait(), interval)
+                self._evict_soon.clear()
+                try:
+                    self.size = await loop.run_in_executor(None, self.evict)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+        finally:
+            self._evict_soon = None
@@ -0,0 +1,186 @@
+"""Durable job queue."""
+import json
+import os
+import socket
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+
+DEFAULT_LEASE = 600
+RENEW_BATCH = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    task TEXT,
+    event TEXT NOT NULL,
+    data BLOB NOT NULL,
+    options TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (lease_until);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT PRIMARY KEY,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deliveries_seen ON deliveries (seen);
+'''
+
+
+class Job(namedtuple('Job', ['id', 'kind', 'task', 'event', 'data', 'options'])):
+    """Job record."""
+
+
+def get_owner():
+    """Get an ID for this worker that stays the same across restarts."""
+
+    return os.environ.get('GH_BOT_WORKER_ID') or os.environ.get('DYNO') or socket.gethostname()
+
+
+def open_store():
+    """Open the job store if one is configured."""
+
+    path = os.environ.get('GH_BOT_QUEUE_DB')
+    if not path:
+        return None
+    return JobStore(path)
+
+
+class JobStore:
+    """
+    Record accepted work in SQLite so it survives restarts.
+
+    Each job is written when it is accepted and deleted when it completes. The worker that
+    accepts a job holds a lease on it and renews it until the job is done. Jobs whose lease has
+    run out, or that are leased to this worker from before it restarted, are claimed and replayed.
+
+    The database runs in WAL mode with `synchronous=NORMAL`, so a write is a cheap append to the
+    log and fsyncs are batched into checkpoints instead of happening on every job.
+    """
+
+    def __init__(self, path, lease=None, owner=None):
+        """Initialize."""
+
+        if lease is None:
+            lease = os.environ.get('GH_BOT_QUEUE_LEASE', DEFAULT_LEASE)
+
+        self.lease = float(lease)
+        self.owner = get_owner() if owner is None else owner
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database."""
+
+        self._db.close()
+
+    def add(self, kind, task, event, data, options):
+        """Record an accepted job leased to this worker and return its ID."""
+
+        now = time.time()
+        cursor = self._db.execute(
+            'INSERT INTO jobs (kind, task, event, data, options, owner, lease_until, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                kind,
+                task,
+                event,
+                zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')),
+                json.dumps(options, separators=(',', ':')),
+                self.owner,
+                now + self.lease,
+                now
+            )
+        )
+        return cursor.lastrowid
+
+    def ack(self, job_id):
+        """Remove a completed job."""
+
+        self._db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def renew(self, job_ids):
+        """Extend the lease of jobs this worker holds so no one else claims them while they are queued or running."""
+
+        job_ids = list(job_ids)
+        until = time.time() + self.lease
+        # Stay well under SQLite's limit on the number of query parameters.
+        for start in range(0, len(job_ids), RENEW_BATCH):
+            batch = job_ids[start:start + RENEW_BATCH]
+            self._db.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE owner = ? AND id IN ({', '.join('?' * len(batch))})",
+                (until, self.owner, *batch)
+            )
+
+    def claim(self, startup=False):
+        """
+        Claim jobs that need to be replayed.
+
+        Jobs whose lease has run out are claimed. At startup, jobs still leased to this
+        worker are claimed as well since the process that held them is gone.
+        """
+
+        now = time.time()
+        query = 'SELECT id, kind, task, event, data, options FROM jobs WHERE lease_until < ?'
+        params = (now,)
+        if startup:
+            query += ' OR owner = ?'
+            params += (self.owner,)
+
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._db.execute(query + ' ORDER BY id', params).fetchall()
+            self._db.executemany(
+                'UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ?',
+                [(self.owner, now + self.lease, row[0]) for row in rows]
+            )
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+        return [
+            Job(
+                row[0],
+                row[1],
+                row[2],
+                row[3],
+                json.loads(zlib.decompress(row[4]).decode('utf-8')),
+                json.loads(row[5])
+            )
+            for row in rows
+        ]
+
+    def has_delivery(self, delivery_id, ttl):
+        """Check if a delivery ID was recorded within the last `ttl` seconds."""
+
+        row = self._db.execute(
+            'SELECT 1 FROM deliveries WHERE id = ? AND seen >= ?',
+            (delivery_id, time.time() - ttl)
+        ).fetchone()
+        return row is not None
+
+    def add_delivery(self, delivery_id):
+        """Record a handled delivery ID."""
+
+        self._db.execute(
+            'INSERT OR REPLACE INTO deliveries (id, seen) VALUES (?, ?)',
+            (delivery_id, time.time())
+        )
+
+    def remove_delivery(self, delivery_id):
+        """Forget a delivery ID."""
+
+        self._db.execute('DELETE FROM deliveries WHERE id = ?', (delivery_id,))
+
+    def prune_deliveries(self, ttl):
+        """Forget delivery IDs older than `ttl` seconds."""
+
+        self._db.execute('DELETE FROM deliveries WHERE seen < ?', (time.time() - ttl,))
@@ -1,16 +1,17 @@
 """Looks good to me command."""
 import traceback
 import sys
+from . import metrics
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'lgtm')
 async def run(event, gh, config):
     """Run the task."""
 
     print(f'LGTM: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('lgtm')
         await lgtm(event, gh, config)
         success = True
     except Exception:
@@ -24,9 +25,8 @@ async def run(event, gh, config):
 async def lgtm(event, gh, config, **kwargs):
     """Remove specified labels, and set desired labels if specified."""
 
-    key = 'lgtm_add_pull_request' if event.event == 'pull_request' else 'lgtm_add_issue'
-    add_labels = {value.lower(): value for value in config.get(key, [])}
-    remove_labels = {label.lower(): label for label in config.get('lgtm_remove', [])}
+    add_labels = dict(config.lgtm_add_pull_request if event.event == 'pull_request' else config.lgtm_add_issue)
+    remove_labels = config.lgtm_remove
 
     add = []
     remove = []
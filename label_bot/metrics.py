@@ -0,0 +1,256 @@
+"""Instrumentation exposed in the Prometheus text format."""
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DEFAULT_LAG_INTERVAL = 0.5
+
+registry = []
+
+
+def _escape(value):
+    """Escape a label value."""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    """Format labels."""
+
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    """Format a number."""
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base metric."""
+
+    kind = ''
+
+    def __init__(self, name, documentation, labels=()):
+        """Initialize."""
+
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def header(self):
+        """Get the help and type lines."""
+
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def samples(self):
+        """Get the sample lines."""
+
+        return []
+
+    def render(self):
+        """Render the metric."""
+
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    """Counter."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """Initialize."""
+
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *values, amount=1):
+        """Increment the counter."""
+
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, *values):
+        """Get the count."""
+
+        return self._values.get(values, 0)
+
+    def samples(self):
+        """Get the sample lines."""
+
+        values = self._values if self._values or self.labels else {(): 0}
+        return [
+            f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Gauge whose samples are collected by a callback when rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        """Initialize."""
+
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self):
+        """Get the sample lines."""
+
+        values = self.collect() if self.collect is not None else {}
+        return [
+            f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Histogram."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        """Initialize."""
+
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, *values, value):
+        """Record an observation."""
+
+        entry = self._values.get(values)
+        if entry is None:
+            entry = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, *values):
+        """Time the block."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*values, value=time.perf_counter() - start)
+
+    def samples(self):
+        """Get the sample lines."""
+
+        lines = []
+        for values, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_labels(self.labels, values, ("le", _number(bound)))} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{_labels(self.labels, values)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, values)} {cumulative}')
+        return lines
+
+
+def timed(histogram, *values):
+    """Decorate a coroutine function to record how long it takes."""
+
+    def decorator(function):
+        """Decorator."""
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            """Wrapper."""
+
+            with histogram.time(*values):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def endpoint(url):
+    """Reduce a GitHub API URL to its endpoint so it can be used as a label."""
+
+    parts = urlsplit(url).path.strip('/').split('/')
+    if len(parts) >= 3 and parts[0] == 'repos':
+        parts[1:3] = [':owner', ':repo']
+
+    normalized = []
+    previous = ''
+    for part in parts:
+        if previous in ('labels', 'branches', 'statuses', 'commits'):
+            part = ':name'
+        elif previous == 'contents':
+            normalized.append(':path')
+            break
+        elif part.isdigit():
+            part = ':number'
+        normalized.append(part)
+        previous = part
+    return '/' + '/'.join(normalized)
+
+
+def render():
+    """Render every metric."""
+
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram(
+    'labelbot_handler_seconds', 'Time spent in webhook handlers.', ['handler']
+)
+TASK_SECONDS = Histogram(
+    'labelbot_task_seconds', 'Time spent running tasks.', ['task']
+)
+GITHUB_REQUESTS = Counter(
+    'labelbot_github_requests_total', 'GitHub API calls.', ['method', 'endpoint', 'status']
+)
+GITHUB_CACHE = Counter(
+    'labelbot_github_cache_total', 'GitHub API reads by whether the HTTP cache revalidated them.', ['result']
+)
+DUPLICATE_DELIVERIES = Counter(
+    'labelbot_duplicate_deliveries_total', 'Redelivered webhooks that were dropped.'
+)
+
+
+def _cache_ratio():
+    """Collect the HTTP cache hit ratio."""
+
+    hits = GITHUB_CACHE.get('hit')
+    total = hits + GITHUB_CACHE.get('miss')
+    return {(): hits / total if total else 0.0}
+
+
+GITHUB_CACHE_RATIO = Gauge(
+    'labelbot_github_cache_hit_ratio', 'Share of GitHub API reads answered by the HTTP cache.', collect=_cache_ratio
+)
+EVENT_LOOP_LAG = Histogram(
+    'labelbot_event_loop_lag_seconds', 'How late the event loop ran a timer, measured periodically.',
+    buckets=LAG_BUCKETS
+)
+
+
+async def monitor_lag(interval=DEFAULT_LAG_INTERVAL):
+    """Measure how late the event loop wakes up from a sleep, which is how long something blocked it."""
+
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(value=lag)
@@ -0,0 +1,93 @@
+"""Run CPU bound work off the event loop."""
+import asyncio
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import metrics
+
+DEFAULT_EXECUTOR = 'thread'
+DEFAULT_WORKERS = 2
+# Work smaller than this runs inline, as handing it off would cost more than it saves.
+# Sizes are in characters for `yaml` and `html`, and in files times rules for `glob`.
+DEFAULT_THRESHOLDS = {
+    'yaml': 64 * 1024,
+    'html': 64 * 1024,
+    'glob': 10000
+}
+# Work on objects that can't be sent to another process, which always uses threads.
+THREAD_ONLY = frozenset(['glob'])
+
+OFFLOADED = metrics.Counter(
+    'labelbot_offloaded_total', 'CPU bound work by kind and where it ran.', ['work', 'executor']
+)
+
+
+def get_thresholds():
+    """Get the size threshold of each kind of work, with any overrides from `GH_BOT_OFFLOAD_THRESHOLD`."""
+
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for item in os.environ.get('GH_BOT_OFFLOAD_THRESHOLD', '').split(','):
+        if '=' in item:
+            name, size = item.split('=', 1)
+            thresholds[name.strip()] = int(size)
+    return thresholds
+
+
+class Offloader:
+    """
+    Run CPU bound work inline, or in a thread or process pool, depending on its size.
+
+    With the `process` executor, work runs in other processes, so functions and their arguments and
+    results must be picklable. Work in `THREAD_ONLY` uses a thread pool instead. With the `inline`
+    executor, everything runs on the event loop. Pools are created the first time they are needed.
+    """
+
+    def __init__(self, executor=None, workers=None, thresholds=None):
+        """Initialize."""
+
+        if executor is None:
+            executor = os.environ.get('GH_BOT_EXECUTOR', DEFAULT_EXECUTOR)
+        if workers is None:
+            workers = os.environ.get('GH_BOT_EXECUTOR_WORKERS', DEFAULT_WORKERS)
+
+        if executor not in ('thread', 'process', 'inline'):
+            raise ValueError(f"Unknown executor '{executor}'")
+
+        self.executor = executor
+        self.workers = max(1, int(workers))
+        self.thresholds = get_thresholds() if thresholds is None else thresholds
+        self._pools = {}
+
+    def get_pool(self, kind):
+        """Get the pool of the given kind, creating it if needed."""
+
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == 'process':
+                pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='label-bot')
+            self._pools[kind] = pool
+        return pool
+
+    async def run(self, work, size, function, *args):
+        """Run `function(*args)` and get its result, offloading it if `size` reaches the work's threshold."""
+
+        if self.executor == 'inline' or size < self.thresholds.get(work, DEFAULT_THRESHOLDS.get(work, 0)):
+            OFFLOADED.inc(work, 'inline')
+            return function(*args)
+
+        kind = 'thread' if work in THREAD_ONLY else self.executor
+        OFFLOADED.inc(work, kind)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_pool(kind), functools.partial(function, *args))
+
+    def close(self):
+        """Shut down the pools."""
+
+        for pool in self._pools.values():
+            pool.shutdown(wait=False)
+        self._pools.clear()
+
+
+pool = Offloader()
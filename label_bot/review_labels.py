@@ -1,6 +1,7 @@
 """Review labels."""
 import traceback
 import sys
+from . import metrics
 from . import util
 
 DEFAULT = 'needs-review'
@@ -11,16 +12,15 @@ DEFAULT_REMOVE = []
 async def review(event, gh, config):
     """Add review labels."""
 
-    review_label = config.get('review_label', DEFAULT)
-    add_labels = {review_label.lower(): review_label}
-    remove_labels = {label.lower(): label for label in config.get('review_remove', DEFAULT_REMOVE)}
-    skip = set([label.lower() for label in config.get('review_skip', DEFAULT_SKIP)])
+    add_labels = dict(config.review_add)
+    remove_labels = config.review_remove
+    skip = config.review_skip
 
     add = []
     remove = []
 
     # Nothing to add
-    if not review_label:
+    if not add_labels:
         return
 
     async for name in event.get_issue_labels(gh):
@@ -41,14 +41,14 @@ async def review(event, gh, config):
     await event.add_issue_labels(gh, add)
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'review')
 async def run(event, gh, config, **kwargs):
     """Run the task."""
 
     print(f'REVIEW: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('review')
         await review(event, gh, config)
         success = True
     except Exception:
@@ -0,0 +1,179 @@
+"""Keyed job scheduling."""
+import asyncio
+import contextlib
+import itertools
+import os
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_DEBOUNCE = 2.0
+
+
+def get_concurrency():
+    """Get the global concurrency limit."""
+
+    return max(1, int(os.environ.get('GH_BOT_CONCURRENCY', DEFAULT_CONCURRENCY)))
+
+
+def get_key(data):
+    """Get the scheduling key for a raw webhook payload."""
+
+    number = None
+    for key in ('pull_request', 'issue'):
+        if key in data:
+            number = str(data[key]['number'])
+            break
+    return (data['repository']['full_name'], number)
+
+
+class RepositoryGate:
+    """
+    Let work on a repository's issues run together, but work on the repository itself run alone.
+
+    Work on the repository itself (like a label sync) waits for running issue work to finish, and
+    issue work that arrives while it waits or runs waits for it, so a long burst of issue work
+    can't hold it off forever.
+    """
+
+    def __init__(self):
+        """Initialize."""
+
+        self._changed = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        """Hold the gate alongside other issue work."""
+
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._shared -= 1
+                self._changed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Hold the gate alone."""
+
+        async with self._changed:
+            self._waiting += 1
+            try:
+                await self._changed.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._waiting -= 1
+                # Issue work held off by this wait may be able to go now.
+                self._changed.notify_all()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._exclusive = False
+                self._changed.notify_all()
+
+
+class KeyedScheduler:
+    """
+    Run work for different keys in parallel, and work for the same key in order.
+
+    A key is usually a repository and issue/pull request number. Work that shares a
+    key is run one at a time in the order it arrived so label updates don't race.
+    Work with different keys runs in parallel, but never more than the global limit.
+    Work keyed to a repository without a number (like a label sync) changes the labels
+    every issue uses, so it doesn't run alongside any other work in that repository.
+    """
+
+    def __init__(self, limit=None):
+        """Initialize."""
+
+        self._limit = asyncio.Semaphore(get_concurrency() if limit is None else limit)
+        self._locks = {}
+        self._gates = {}
+        self._users = {}
+
+    def _acquire(self, items, key, factory):
+        """Get the lock or gate for a key, creating it if needed, and count another user."""
+
+        item = items.get(key)
+        if item is None:
+            item = items[key] = factory()
+        self._users[key] = self._users.get(key, 0) + 1
+        return item
+
+    def _release(self, items, key):
+        """Count one less user of a key's lock or gate, dropping it once there are none."""
+
+        self._users[key] -= 1
+        if not self._users[key]:
+            del self._users[key]
+            del items[key]
+
+    async def run(self, key, coro):
+        """Run the coroutine once its key, its repository, and a global slot are free."""
+
+        repository = (key[0],)
+        lock = self._acquire(self._locks, key, asyncio.Lock)
+        gate = self._acquire(self._gates, repository, RepositoryGate)
+
+        try:
+            # Wait on the key and repository first so queued work for them doesn't hold a global slot.
+            async with lock:
+                async with (gate.exclusive() if key[1] is None else gate.shared()):
+                    async with self._limit:
+                        return await coro
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        finally:
+            self._release(self._gates, repository)
+            self._release(self._locks, key)
+
+
+class Coalescer:
+    """
+    Collapse bursts of work for the same target into one run.
+
+    Each piece of work claims its target. Work waits for the debounce window, and only the
+    newest claim for a target still runs. Older work, whether it is waiting out the window
+    or queued behind a running job, finds it has been superseded and does nothing.
+    """
+
+    def __init__(self, window=None):
+        """Initialize."""
+
+        if window is None:
+            window = os.environ.get('GH_BOT_DEBOUNCE', DEFAULT_DEBOUNCE)
+
+        self.window = float(window)
+        self._latest = {}
+        self._tokens = itertools.count()
+
+    def claim(self, key):
+        """Claim the target, superseding any earlier claim."""
+
+        token = next(self._tokens)
+        self._latest[key] = token
+        return token
+
+    def is_current(self, key, token):
+        """Check if the claim is still the newest for the target."""
+
+        return self._latest.get(key) == token
+
+    def release(self, key, token):
+        """Release the claim once its work is done, unless newer work has claimed the target."""
+
+        if self.is_current(key, token):
+            del self._latest[key]
+
+    async def wait(self, key, token):
+        """Wait out the debounce window and report whether the claim is still the newest."""
+
+        if self.window > 0:
+            await asyncio.sleep(self.window)
+        return self.is_current(key, token)
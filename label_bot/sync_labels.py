@@ -1,18 +1,58 @@
 """Label syncing."""
-import asyncio
 from collections import namedtuple
+import asyncio
+import os
 import re
 import traceback
 import sys
+import cachetools
+from . import metrics
 from . import util
 
 RE_VALID_COLOR = re.compile('#[a-fA-F0-9]{6}')
 
+DEFAULT_CONCURRENCY = 4
+# Push payloads list at most this many commits.
+MAX_PUSH_COMMITS = 20
+
+# Fingerprint of the configuration each repository was last synced with.
+synced = cachetools.LRUCache(maxsize=1024)
+
 
 class LabelEdit(namedtuple('LabelEdit', ['old', 'new', 'color', 'description', 'modified'])):
     """Label Edit tuple."""
 
 
+class LabelChange(namedtuple('LabelChange', ['stage', 'action', 'args'])):
+    """Planned repository label change."""
+
+
+def get_concurrency():
+    """Get the number of label changes that can be made at the same time."""
+
+    return max(1, int(os.environ.get('GH_BOT_SYNC_CONCURRENCY', DEFAULT_CONCURRENCY)))
+
+
+def get_changed_paths(data):
+    """
+    Get the paths a push changed.
+
+    The changed paths of each commit are listed in the payload. If they can't be trusted to be
+    complete (no commits, a forced push, or too many commits to be listed), `None` is returned
+    to say anything could have changed.
+    """
+
+    commits = data.get('commits')
+    if not commits or data.get('forced', False) or len(commits) >= MAX_PUSH_COMMITS:
+        return None
+
+    paths = set()
+    for commit in commits:
+        for key in ('added', 'modified', 'removed'):
+            paths.update(commit.get(key, []))
+    return paths
+
+
 def _validate_str(name):
     """Validate name."""
 
@@ -53,53 +93,69 @@ def _parse_colors(config):
     return colors
 
 
-def _find_label(labels, label, label_color, label_description):
-    """Find label."""
+def _index_labels(labels):
+    """
+    Index the labels by lowered name and by lowered previous name.
 
-    edit = None
-    for value in labels:
+    Each name maps to the first label that has it, which is the label a scan of the list would find.
+    """
+
+    by_name = {}
+    by_old = {}
+    for index, value in enumerate(labels):
         name = value['name']
-        old_name = value.get('renamed', name)
+        by_name.setdefault(name.lower(), index)
+        by_old.setdefault(value.get('renamed', name).lower(), index)
+    return by_name, by_old
 
-        if label.lower() != old_name.lower():
-            if label.lower() == name.lower():
-                old_name = name
-            else:
-                continue
 
-        new_name = name
-        color = value['color']
-        description = value.get('description', '')
-        modified = False
-
-        # Editing an existing label
-        if (
-            label.lower() == old_name.lower() and
-            (
-                label_color.lower() != color.lower() or
-                label_description != description or
-                label != old_name or
-                label.lower() != new_name.lower()
-            )
-        ):
-            modified = True
-        edit = LabelEdit(old_name, new_name, color, description, modified=modified)
-        break
-
-    return edit
-
-
-def _parse_labels(config):
+def _find_label(labels, label, label_color, label_description, index=None):
+    """Find label."""
+
+    if index is None:
+        index = _index_labels(labels)
+    by_name, by_old = index
+
+    low = label.lower()
+    found_old = by_old.get(low)
+    found_name = by_name.get(low)
+    if found_old is None and found_name is None:
+        return None
+
+    # The first label that was either renamed from this name or has this name wins.
+    if found_name is None or (found_old is not None and found_old <= found_name):
+        value = labels[found_old]
+        old_name = value.get('renamed', value['name'])
+    else:
+        value = labels[found_name]
+        old_name = value['name']
+
+    new_name = value['name']
+    color = value['color']
+    description = value.get('description', '')
+
+    # Editing an existing label
+    modified = (
+        label_color.lower() != color.lower() or
+        label_description != description or
+        label != old_name or
+        low != new_name.lower()
+    )
+    return LabelEdit(old_name, new_name, color, description, modified=modified)
+
+
+def _parse_labels(config, colors=None):
     """Parse labels."""
 
     labels = []
     seen = set()
-    colors = _parse_colors(config)
+    if colors is None:
+        colors = _parse_colors(config)
     for value in config.get('labels', []):
         try:
             name = value['name']
             _validate_str(name)
-            value['color'] = _resolve_color(value['color'], colors)
+            value = dict(value, color=_resolve_color(value['color'], colors))
             if 'renamed' in value:
                 _validate_str(value['renamed'])
             if 'description' in value and not isinstance(value['description'], str):
@@ -122,50 +178,57 @@ def _parse_labels(config):
     return labels, ignores
 
 
-async def sync(event, gh, config):
-    """Sync labels."""
+def _plan_sync(labels, ignores, repo_labels, delete):
+    """
+    Plan the changes needed to sync the repository labels.
 
-    labels, ignores = _parse_labels(config)
-    delete = config.get('delete_labels', False)
-    evaluated = set()
+    Repository labels are evaluated in order, and a rename only goes ahead if its new name is free
+    at that point, so a rename can depend on an earlier change freeing the name. Each change is
+    given a stage: changes in the same stage are independent, and a rename that takes a freed name
+    is placed in a later stage than the change that frees it.
+    """
 
-    # No labels defined, assume this has not been configured
-    if not labels:
-        return
-
-    # Get all labels before we start modifying labels.
-    repo_labels = [label async for label in event.get_repo_labels(gh)]
+    index = _index_labels(labels)
+    evaluated = set()
     current_names = set([value['name'].lower() for value in repo_labels])
+    # Stage of the change that freed a name.
+    freed = {}
+    changes = []
 
     # Iterate labels deleting or updating labels that need it.
     for label in repo_labels:
-        edit = _find_label(labels, label['name'], label['color'], label['description'])
+        edit = _find_label(labels, label['name'], label['color'], label['description'], index)
         if edit is not None and edit.modified:
-            already_exists = edit.old.lower() != edit.new.lower() and edit.new.lower() in current_names
+            old = edit.old.lower()
+            new = edit.new.lower()
+            already_exists = old != new and new in current_names
             if already_exists and delete:
                 print(f'SYNC: Deleting {label["name"]}: #{label["color"]} "{label["description"]}"')
-                await event.remove_repo_label(gh, edit.old)
-                current_names.remove(edit.old.lower())
-                await asyncio.sleep(1)
+                changes.append(LabelChange(0, 'remove', (edit.old,)))
+                current_names.remove(old)
+                freed[old] = 0
             elif not already_exists:
                 print(f'SYNC: Updating {edit.new}: #{edit.color} "{edit.description}"')
-                await event.update_repo_label(gh, edit.old, edit.new, edit.color, edit.description)
-                current_names.remove(edit.old.lower())
-                current_names.add(edit.new.lower())
-                await asyncio.sleep(1)
+                stage = freed.pop(new) + 1 if old != new and new in freed else 0
+                changes.append(LabelChange(stage, 'update', (edit.old, edit.new, edit.color, edit.description)))
+                current_names.remove(old)
+                current_names.add(new)
+                if old != new:
+                    freed[old] = stage
             else:
                 print(f'SYNC: Skipping {label["name"]}: #{label["color"]} "{label["description"]}"')
-            evaluated.add(edit.old.lower())
-            evaluated.add(edit.new.lower())
+            evaluated.add(old)
+            evaluated.add(new)
         else:
-            if edit is None and delete and label['name'].lower() not in ignores:
+            low = label['name'].lower()
+            if edit is None and delete and low not in ignores:
                 print(f'SYNC: Deleting {label["name"]}: #{label["color"]} "{label["description"]}"')
-                await event.remove_repo_label(gh, label['name'])
-                current_names.remove(label['name'].lower())
-                await asyncio.sleep(1)
+                changes.append(LabelChange(0, 'remove', (label['name'],)))
+                current_names.remove(low)
+                freed[low] = 0
             else:
                 print(f'SYNC: Skipping {label["name"]}: #{label["color"]} "{label["description"]}"')
-            evaluated.add(label['name'].lower())
+            evaluated.add(low)
 
     # Create any labels that need creation.
     for value in labels:
@@ -176,8 +239,49 @@ async def sync(event, gh, config):
         # If the name has already been evaluated, we've likely already added the name or removed it intentionally.
         if name.lower() not in evaluated:
             print(f'SYNC: Creating {name}: #{color} "{description}"')
-            await event.add_repo_label(gh, name, color, description)
-            await asyncio.sleep(1)
+            changes.append(LabelChange(0, 'add', (name, color, description)))
+
+    return changes
+
+
+async def _apply_sync(event, gh, changes, concurrency):
+    """
+    Apply the planned changes a stage at a time.
+
+    Changes within a stage run in parallel up to the concurrency limit, and every call still goes
+    through the rate limit aware throttler. If any change fails, the rest of its stage finishes,
+    but no later stage is started.
+    """
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def apply(change):
+        """Apply a change."""
+
+        async with limit:
+            await getattr(event, f'{change.action}_repo_label')(gh, *change.args)
+
+    for stage in range(max([change.stage for change in changes], default=-1) + 1):
+        results = await asyncio.gather(
+            *[apply(change) for change in changes if change.stage == stage],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+
+async def sync(event, gh, config):
+    """Sync labels."""
+
+    # No labels defined, assume this has not been configured
+    if not config.labels:
+        return
+
+    # Get all labels before we start modifying labels.
+    repo_labels = [label async for label in event.get_repo_labels(gh)]
+    changes = _plan_sync(config.labels, config.ignores, repo_labels, config.delete_labels)
+    await _apply_sync(event, gh, changes, get_concurrency())
 
 
 async def pending(event, gh):
@@ -186,18 +290,33 @@ async def pending(event, gh):
     await event.set_status(gh, util.EVT_PENDING, 'labels/sync', 'Pending')
 
 
-async def run(event, gh, config, **kwargs):
-    """Run task."""
+@metrics.timed(metrics.TASK_SECONDS, 'sync')
+async def run(event, gh, config, force=False, **kwargs):
+    """
+    Run task.
+
+    Unless forced, the sync is skipped (without setting any status) when the repository was already
+    synced with the same configuration.
+    """
 
     print(f'SYNC: {event.full_name}')
 
+    fingerprint = config.fingerprint
+    if fingerprint is not None:
+        if not force and synced.get(event.full_name) == fingerprint:
+            print(f'SYNC: Skipping {event.full_name}, the configuration has not changed')
+            return
+
+    await pending(event, gh)
+
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('labels')
         await sync(event, gh, config)
+        synced[event.full_name] = fingerprint
         success = True
     except Exception:
         traceback.print_exc(file=sys.stdout)
+        synced.pop(event.full_name, None)
         success = False
 
     await event.set_status(
@@ -0,0 +1,120 @@
+"""Rate limit aware throttling of GitHub API calls."""
+import asyncio
+import os
+import time
+from gidgethub import sansio
+
+MUTATING = frozenset(['POST', 'PATCH', 'PUT', 'DELETE'])
+
+# GitHub asks that mutating requests be spaced out by about a second to avoid secondary rate limits.
+DEFAULT_WRITE_INTERVAL = 1.0
+# When the remaining budget drops below this, start spreading calls out over the time left until the reset.
+DEFAULT_RESERVE = 500
+# Number of times a request will be retried when GitHub asks us to back off with `Retry-After`.
+DEFAULT_RETRIES = 3
+
+_throttlers = {}
+
+
+def get(key, name='default'):
+    """
+    Get the shared throttler for a rate limit bucket (normally a token).
+
+    The name identifies the bucket in metrics and logs, so it should never be the token itself.
+    """
+
+    throttler = _throttlers.get(key)
+    if throttler is None:
+        throttler = _throttlers[key] = Throttler(name=name)
+    return throttler
+
+
+def throttlers():
+    """Get all the shared throttlers."""
+
+    return list(_throttlers.values())
+
+
+class Throttler:
+    """
+    Throttle GitHub API calls for one rate limit bucket.
+
+    Calls go through at full speed while the budget is plentiful. Mutating calls are spaced
+    out to respect secondary rate limits, and all calls back off when GitHub tells us to
+    (`Retry-After`) or when the remaining budget is nearly used up.
+    """
+
+    def __init__(self, write_interval=None, reserve=None, retries=None, name='default'):
+        """Initialize."""
+
+        if write_interval is None:
+            write_interval = os.environ.get('GH_BOT_WRITE_INTERVAL', DEFAULT_WRITE_INTERVAL)
+        if reserve is None:
+            reserve = os.environ.get('GH_BOT_RATE_RESERVE', DEFAULT_RESERVE)
+
+        self.name = name
+        self.write_interval = float(write_interval)
+        self.reserve = int(reserve)
+        self.retries = DEFAULT_RETRIES if retries is None else retries
+        self.limit = None
+        self.remaining = None
+        self.reset = 0.0
+        self.blocked_until = 0.0
+        self._next_call = 0.0
+        self._next_write = 0.0
+
+    def delay(self, method):
+        """Get how long a call must wait, reserving its slot if it mutates."""
+
+        now = time.time()
+        start = now
+
+        if self.blocked_until > start:
+            start = self.blocked_until
+
+        if self.remaining is not None and self.reset > now:
+            if self.remaining <= 0:
+                start = max(start, self.reset)
+            elif self.remaining < self.reserve:
+                # Spread what is left of the budget evenly over the time left until it resets.
+                start = max(start, self._next_call)
+                self._next_call = start + (self.reset - now) / self.remaining
+            self.remaining -= 1
+
+        if method.upper() in MUTATING:
+            start = max(start, self._next_write)
+            self._next_write = start + self.write_interval
+
+        return start - now
+
+    async def acquire(self, method):
+        """Wait until the call is allowed to go through."""
+
+        delay = self.delay(method)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update(self, status, headers):
+        """
+        Update the budget from a response.
+
+        Returns the number of seconds to wait before retrying if GitHub asked us to back off,
+        otherwise `None`.
+        """
+
+        # Other resources, like GraphQL, have budgets of their own.
+        rate_limit = sansio.RateLimit.from_http(headers)
+        if rate_limit is not None and headers.get('x-ratelimit-resource', 'core') == 'core':
+            self.limit = rate_limit.limit
+            self.remaining = rate_limit.remaining
+            self.reset = rate_limit.reset_datetime.timestamp()
+
+        retry_after = headers.get('retry-after')
+        if retry_after is not None and status in (403, 429):
+            try:
+                seconds = max(0.0, float(retry_after))
+            except ValueError:
+                seconds = 60.0
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+            return seconds
+        return None
@@ -1,20 +1,21 @@
 """Triage labels."""
 import traceback
 import sys
+from . import metrics
 
 DEFAULT = 'triage'
 DEFAULT_SKIP = ['skip-triage']
 DEFAULT_REMOVE = []
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'triage')
 async def run(event, gh, config, **kwargs):
     """Run task."""
 
     print(f'TRIAGE: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('triage')
         await triage(event, gh, config)
         success = True
     except Exception:
@@ -28,16 +29,15 @@ async def run(event, gh, config, **kwargs):
 async def triage(event, gh, config):
     """Add triage labels."""
 
-    triage_label = config.get('triage_label', DEFAULT)
-    add_labels = {triage_label.lower(): triage_label}
-    remove_labels = {label.lower(): label for label in config.get('triage_remove', DEFAULT_REMOVE)}
-    skip = set([label.lower() for label in config.get('triage_skip', DEFAULT_SKIP)])
+    add_labels = dict(config.triage_add)
+    remove_labels = config.triage_remove
+    skip = config.triage_skip
 
     add = []
     remove = []
 
     # Nothing to add
-    if not triage_label:
+    if not add_labels:
         return
 
     async for name in event.get_issue_labels(gh):
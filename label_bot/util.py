@@ -1,20 +1,22 @@
 """Utilities."""
-import asyncio
-import base64
-import yaml
+import contextlib
+import hashlib
+import json
 import traceback
 import sys
 import os
+from collections.abc import Mapping
 from gidgethub import sansio, InvalidField
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
+from . import auth
+from . import config as configuration
+from . import config_cache
 
 LABEL_HEADER = ','.join([sansio.accept_format(), 'application/vnd.github.symmetra-preview+json'])
 REACTION_HEADER = ','.join([sansio.accept_format(), 'application/vnd.github.squirrel-girl-preview+json'])
 HTML_HEADER = sansio.accept_format(media="html")
 
+CONFIG_PATH = '.github/labels.yml'
+
 SINGLE_VALUES = {
     'brace_expansion', 'extended_glob', 'case_insensitive',
     'triage_label', 'review_label', 'delete_labels'
@@ -34,6 +36,53 @@ EVT_ERROR = "error"
 EVT_PENDING = "pending"
 
 
+def _jsonable(value):
+    """Convert values JSON can't serialize, like frozen mappings and dates."""
+
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+def fingerprint(config):
+    """Get a fingerprint of a configuration that changes whenever its content does."""
+
+    text = json.dumps(config, sort_keys=True, separators=(',', ':'), default=_jsonable)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class IssueLabels:
+    """Staged issue labels."""
+
+    def __init__(self, names):
+        """Initialize."""
+
+        self.original = {name.lower(): name for name in names}
+        self.current = dict(self.original)
+
+    def __iter__(self):
+        """Iterate the current label names."""
+
+        return iter(self.current.values())
+
+    def add(self, names):
+        """Stage labels to add."""
+
+        for name in names:
+            self.current.setdefault(name.lower(), name)
+
+    def remove(self, names):
+        """Stage labels to remove."""
+
+        for name in names:
+            self.current.pop(name.lower(), None)
+
+    def changes(self):
+        """Get the net labels added and removed since the labels were read."""
+
+        add = [name for low, name in self.current.items() if low not in self.original]
+        remove = [name for low, name in self.original.items() if low not in self.current]
+        return add, remove
+
+
 class Event:
     """Event object."""
 
@@ -41,7 +90,12 @@ class Event:
         """Initialize."""
 
         self.event = event_type
+        self.data = data
         self.local_ref = local_ref
+        self._staged = None
+        # Labels and changed files read ahead of time (such as with GraphQL), used once instead of asking the API.
+        self.prefetched_labels = None
+        self.prefetched_files = None
         if self.event == 'push':
             self.sha = data['after']
             self.state = None
@@ -49,6 +103,7 @@ class Event:
             self.base = None
             self.head = None
             self.number = None
+            self.pull_files_url = None
         elif self.event == 'pull_request':
             self.sha = data['pull_request']['head']['sha']
             self.state = data['pull_request']['state']
@@ -56,6 +111,7 @@ class Event:
             self.base = data['pull_request']['base']['label']
             self.head = data['pull_request']['head']['label']
             self.number = str(data['pull_request']['number'])
+            self.pull_files_url = data['pull_request']['url'] + '/files{?per_page}'
         elif self.event == 'issues':
             self.sha = data["repository"]["default_branch"]
             self.state = data['issue']['state']
@@ -63,6 +119,7 @@ class Event:
             self.base = None
             self.head = None
             self.number = str(data['issue']['number'])
+            self.pull_files_url = None
         self.default_branch = data["repository"]["default_branch"]
         self.full_name = data['repository']['full_name']
         self.branches_url = data['repository']['branches_url']
@@ -73,6 +130,7 @@ class Event:
         self.compare_url = data['repository']['compare_url']
         self.labels_url = data['repository']['labels_url']
         self.contents_url = data['repository']['contents_url'] + '{?ref}'
+        self.key = (self.full_name, self.number)
 
     def decode_label(self, name):
         """Decode label."""
@@ -80,63 +138,82 @@ class Event:
         return name.encode('utf-16', 'surrogatepass').decode('utf-16')
 
     def merge_config(self, master_config, config):
-        """Merge master config and local config."""
+        """
+        Merge master config and local config.
+
+        Neither config is modified, as both are shared with the config cache.
+        """
 
         # Normalize configuration files in relation to LGTM options.
         # Use separate options for issue and pull request.
+        configs = []
         for cfg in (master_config, config):
             if 'lgtm_add' in cfg:
+                cfg = dict(cfg)
                 cfg['lgtm_add_issue'] = cfg['lgtm_add'].get('issue', [])
                 cfg['lgtm_add_pull_request'] = cfg['lgtm_add'].get('pull_request', [])
+            configs.append(cfg)
+        master_config, config = configs
 
         if not master_config:
             return config
 
+        merged = dict(master_config)
         for key, value in config.items():
             if key in SINGLE_VALUES:
-                master_config[key] = value
-            elif key in LIST_VALUES and key in master_config:
-                master_config[key].extend(value)
-            elif key in DICT_VALUES and key in master_config:
-                for k, v in value.items():
-                    master_config[key][k] = v
+                merged[key] = value
+            elif key in LIST_VALUES and key in merged:
+                merged[key] = list(merged[key]) + list(value)
+            elif key in DICT_VALUES and key in merged:
+                merged[key] = dict(merged[key])
+                merged[key].update(value)
             else:
-                master_config[key] = value
-        return master_config
+                merged[key] = value
+        return merged
 
-    async def get_config(self, gh):
-        """Get label configuration file."""
+    async def get_config(self, gh, fresh=False):
+        """
+        Get the compiled label configuration.
+
+        A stale template is normally used while it is checked for changes in the background.
+        With `fresh`, the template is always checked for changes before it is used, stale or not.
+        """
 
-        await asyncio.sleep(1)
-        config = {}
         try:
-            result = await gh.getitem(
+            ref = self.sha if self.local_ref else self.default_branch
+            local = await config_cache.cache.load(
+                gh,
+                (self.full_name, CONFIG_PATH, ref),
                 self.contents_url,
-                {
-                    'path': '.github/labels.yml',
-                    'ref': self.sha if self.local_ref else self.default_branch
-                }
+                {'path': CONFIG_PATH, 'ref': ref},
+                immutable=self.local_ref
             )
-            content = base64.b64decode(result['content']).decode('utf-8')
-            config = yaml.load(content, Loader=Loader)
-            template = config.get('template', '')
+            template_config = None
+            template = local.get('template', '')
             if template:
                 user, repo, path, ref = template.split(':')
-                result = await gh.getitem(
-                    'https://api.github.com/repos/{user}/{repo}/contents/{path}/{?ref}',
+                # As a GitHub App, each installation only sees its own repositories, so a template is
+                # only shared within the installation whose token was used to read it.
+                installation = auth.tokens.get_installation(self.data) if auth.enabled() else None
+                # Templates are shared by many repositories and rarely change, so a stale template
+                # is used as is while it is revalidated in the background (unless asked not to).
+                template_config = await config_cache.cache.load(
+                    gh,
+                    (f'{user}/{repo}', path, ref, installation),
+                    '/repos/{user}/{repo}/contents/{path}/{?ref}',
                     {
                         'user': user,
                         'repo': repo,
                         'path': path,
                         'ref': ref
-                    }
+                    },
+                    background=not fresh,
+                    fresh=fresh
                 )
-                content = base64.b64decode(result['content']).decode('utf-8')
-                template_config = yaml.load(content, Loader=Loader)
-                config = self.merge_config(template_config, config)
+            config = configuration.get_config(local, template_config, self.merge_config)
         except Exception:
             traceback.print_exc(file=sys.stdout)
-            config = {'error': str(traceback.format_exc())}
+            config = configuration.Config.from_error(str(traceback.format_exc()))
 
         return config
 
@@ -166,11 +243,7 @@ class Event:
     async def get_repo_labels(self, gh):
         """Get the repository labels."""
 
-        count = 0
         async for label in gh.getiter(self.labels_url, accept=LABEL_HEADER):
-            count += 1
-            if (count % 30) == 0:
-                await asyncio.sleep(1)
             yield label
 
     async def update_repo_label(self, gh, old_name, new_name, color, description):
@@ -216,25 +289,77 @@ class Event:
             if "Validation Failed for 'name'" not in str(e):
                 raise
 
+    @contextlib.asynccontextmanager
+    async def stage_issue_labels(self, gh):
+        """
+        Stage issue label changes and write the net change back once at the end.
+
+        While staged, the issue's labels are read once, and `get_issue_labels`, `add_issue_labels`,
+        and `remove_issue_labels` work against the staged labels instead of the API. Nested calls
+        share the outer stage. Nothing is written if the block fails.
+        """
+
+        if self._staged is not None:
+            yield self._staged
+            return
+
+        self._staged = IssueLabels([name async for name in self._get_issue_labels(gh)])
+        try:
+            yield self._staged
+            await self._write_issue_labels(gh, self._staged)
+        finally:
+            self._staged = None
+
+    async def _write_issue_labels(self, gh, staged):
+        """
+        Write the net staged change.
+
+        Only the labels that were added or removed are written, never the whole set, as the labels
+        were read a while ago and anything changed on the issue since then must be left alone.
+        """
+
+        add, remove = staged.changes()
+
+        print(f'LABELS: Removing: {remove}')
+        print(f'LABELS: Adding: {add}')
+
+        await self._add_issue_labels(gh, add)
+        await self._remove_issue_labels(gh, remove)
+
     async def get_issue_labels(self, gh):
         """Get the issue's labels."""
 
-        count = 0
-        accept = ','.join([sansio.accept_format(), 'application/vnd.github.symmetra-preview+json'])
-        async for label in gh.getiter(self.issue_labels_url, {'number': self.number}, accept=accept):
+        if self._staged is not None:
+            for name in list(self._staged):
+                yield name
+        else:
+            async for name in self._get_issue_labels(gh):
+                yield name
+
+    async def _get_issue_labels(self, gh):
+        """Get the issue's labels from the API."""
 
-            # Not sure how many get returned before it must page, so sleep for
-            # one second on the arbitrary value of 20. That is a lot of labels for
-            # one issue, so it is probably not going to trigger often.
-            count += 1
-            if (count % 20) == 0:
-                await asyncio.sleep(1)
+        if self.prefetched_labels is not None:
+            labels, self.prefetched_labels = self.prefetched_labels, None
+            for name in labels:
+                yield name
+            return
 
+        accept = ','.join([sansio.accept_format(), 'application/vnd.github.symmetra-preview+json'])
+        async for label in gh.getiter(self.issue_labels_url, {'number': self.number}, accept=accept):
             yield label['name']
 
     async def add_issue_labels(self, gh, labels):
         """Add issue labels."""
 
+        if self._staged is not None:
+            self._staged.add(labels)
+        else:
+            await self._add_issue_labels(gh, labels)
+
+    async def _add_issue_labels(self, gh, labels):
+        """Add issue labels through the API."""
+
         if labels:
             await gh.post(
                 self.issue_labels_url,
@@ -246,12 +371,15 @@ class Event:
     async def remove_issue_labels(self, gh, labels):
         """Remove issue labels."""
 
-        count = 0
-        for label in labels:
-            count += 1
-            if (count % 2) == 0:
-                await asyncio.sleep(1)
+        if self._staged is not None:
+            self._staged.remove(labels)
+        else:
+            await self._remove_issue_labels(gh, labels)
 
+    async def _remove_issue_labels(self, gh, labels):
+        """Remove issue labels through the API."""
+
+        for label in labels:
             await gh.delete(
                 self.issue_labels_url,
                 {'number': self.number, 'name': label},
@@ -2,6 +2,8 @@
 from wcmatch import glob
 import traceback
 import sys
+from . import metrics
+from . import offload
 from . import util
 
 
@@ -20,34 +22,136 @@ def get_flags(config):
     return flags
 
 
-def get_labels(rules, files, flags):
-    """Sync labels."""
+# Characters that could give a pattern special meaning under any of the flags we use.
+MAGIC = frozenset('*?[]\\|{}()!@+')
+# Pattern endings that match everything under a directory (`DOTGLOB` is always enabled).
+PREFIX_SUFFIXES = ('/**/*', '/**')
+# Number of files matched at a time (also the page size used when requesting changed files).
+BATCH_SIZE = 100
 
-    add_labels = {}
-    for file in files:
-        for label in rules:
-            try:
-                names = label['labels']
-                lows = [n.lower() for n in names]
-            except Exception:
-                traceback.print_exc(file=sys.stdout)
-                continue
 
-            match = False
-            for pattern in label['patterns']:
-                try:
-                    match = glob.globmatch(file, pattern, flags=flags)
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
-                    match = False
-                if match:
+def is_literal(pattern, flags):
+    """Check if a pattern can only match the exact path it spells out."""
+
+    if not pattern or pattern.startswith('/') or pattern.endswith('/') or '//' in pattern:
+        return False
+    if flags & glob.MINUSNEGATE and pattern.startswith('-'):
+        return False
+    if any(c in MAGIC for c in pattern):
+        return False
+    return all(part not in ('.', '..') for part in pattern.split('/'))
+
+
+def classify(pattern, flags):
+    """
+    Sort a pattern into a matching tier.
+
+    Returns `('literal', path)` for a plain file path, `('prefix', directory)` for a plain
+    directory followed by `/**` or `/**/*`, and `('glob', None)` for everything else.
+    """
+
+    if is_literal(pattern, flags):
+        return 'literal', pattern
+    for suffix in PREFIX_SUFFIXES:
+        if pattern.endswith(suffix):
+            directory = pattern[:-len(suffix)]
+            if is_literal(directory, flags):
+                return 'prefix', directory
+            break
+    return 'glob', None
+
+
+class FileIndex:
+    """
+    Index of changed files for literal and directory prefix lookups.
+
+    Each file path and each of its parent directories is mapped to the index of the first
+    file it covers, so literal and prefix patterns are answered with a single lookup, and the
+    index grows with the number of distinct directories rather than files times patterns.
+    """
+
+    __slots__ = ('files', 'paths', 'directories', 'ignorecase')
+
+    def __init__(self, files, flags=0):
+        """Initialize."""
+
+        self.files = files
+        self.paths = {}
+        self.directories = {}
+        self.ignorecase = bool(flags & glob.IGNORECASE)
+
+        paths = self.paths
+        directories = self.directories
+        for index, file in enumerate(files):
+            if self.ignorecase:
+                file = file.lower()
+            if file not in paths:
+                paths[file] = index
+            end = file.rfind('/')
+            while end > 0:
+                directory = file[:end]
+                if directory in directories:
                     break
-            if match:
-                for index, low in enumerate(lows):
-                    if low not in add_labels:
-                        add_labels[low] = names[index]
+                directories[directory] = index
+                end = file.rfind('/', 0, end)
+
+    def __len__(self):
+        """Get number of files."""
 
-    remove_labels = {}
+        return len(self.files)
+
+
+class Rule:
+    """Compiled wildcard rule."""
+
+    __slots__ = ('names', 'lows', 'literals', 'prefixes', 'matchers')
+
+    def __init__(self, names, lows, literals, prefixes, matchers):
+        """Initialize."""
+
+        self.names = names
+        self.lows = lows
+        self.literals = literals
+        self.prefixes = prefixes
+        self.matchers = matchers
+
+    def first_match(self, index, limit):
+        """Get the index of the first file (before `limit`) that matches the rule."""
+
+        best = limit
+        for path in self.literals:
+            found = index.paths.get(path.lower() if index.ignorecase else path)
+            if found is not None and found < best:
+                best = found
+
+        for directory, matcher in self.prefixes:
+            if index.ignorecase:
+                directory = directory.lower()
+            found = index.directories.get(directory)
+            if found is not None and found < best:
+                best = found
+
+            # Whether `dir/**` also matches a file named `dir` is left to wcmatch.
+            found = index.paths.get(directory)
+            if found is not None and found < best and matcher is not None and matcher.match(index.files[found]):
+                best = found
+
+        matchers = self.matchers
+        if matchers:
+            files = index.files
+            for found in range(best):
+                file = files[found]
+                for matcher in matchers:
+                    if matcher.match(file):
+                        return found
+
+        return best if best < limit else None
+
+
+def compile_rules(rules, flags):
+    """Compile the rules' patterns once so they can be matched against any number of files."""
+
+    compiled = []
     for label in rules:
         try:
             names = label['labels']
@@ -56,35 +160,171 @@ def get_labels(rules, files, flags):
             traceback.print_exc(file=sys.stdout)
             continue
 
-        for index, low in enumerate(lows):
-            if low not in add_labels and low not in remove_labels:
-                remove_labels[low] = names[index]
+        literals = []
+        prefixes = []
+        matchers = []
+        for pattern in label['patterns']:
+            try:
+                tier, path = classify(pattern, flags)
+                if tier == 'literal':
+                    literals.append(path)
+                elif tier == 'prefix':
+                    prefixes.append((path, glob.compile(pattern, flags=flags) if pattern.endswith('/**') else None))
+                else:
+                    matchers.append(glob.compile(pattern, flags=flags))
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+        compiled.append(Rule(names, lows, literals, prefixes, matchers))
+    return compiled
+
 
-    return add_labels, remove_labels
+class Matches:
+    """
+    Match compiled rules against batches of indexed files.
+
+    Rules are evaluated one at a time, and a rule only needs its first matching file.
+    When a label is named by more than one rule, the name used is the one that the
+    earliest file matched first, which is the same as walking files then rules.
+    Once all of a rule's labels are claimed, only files before the latest claim can
+    change the outcome, so the rest are never checked. A rule is decided once it
+    matches or can no longer change the outcome, and when every rule is decided,
+    no more files are needed.
+    """
+
+    def __init__(self, rules):
+        """Initialize."""
+
+        self.rules = rules
+        self.claims = {}
+        self.pending = [r for r, rule in enumerate(rules) if rule.lows]
+        self.offset = 0
+
+    @property
+    def done(self):
+        """Check if every rule is decided."""
+
+        return not self.pending
+
+    def feed(self, index):
+        """Match the undecided rules against the next batch of files."""
+
+        claims = self.claims
+        offset = self.offset
+        pending = []
+        for r in self.pending:
+            rule = self.rules[r]
+
+            limit = len(index)
+            truncated = False
+            if all(low in claims for low in rule.lows):
+                latest = max(claims[low][0] for low in rule.lows) - offset
+                if latest < limit:
+                    limit = latest
+                    truncated = True
+
+            found = rule.first_match(index, limit) if limit > 0 else None
+            if found is None:
+                if not truncated:
+                    pending.append(r)
+                continue
+
+            found += offset
+            for i, low in enumerate(rule.lows):
+                claim = claims.get(low)
+                if claim is None or found < claim[0]:
+                    claims[low] = (found, r, i, rule.names[i])
+
+        self.pending = pending
+        self.offset += len(index)
+
+    def result(self):
+        """Get the labels to add and remove."""
+
+        add_labels = {}
+        for low, claim in sorted(self.claims.items(), key=lambda item: item[1][:3]):
+            add_labels[low] = claim[3]
+
+        remove_labels = {}
+        for rule in self.rules:
+            for index, low in enumerate(rule.lows):
+                if low not in add_labels and low not in remove_labels:
+                    remove_labels[low] = rule.names[index]
+
+        return add_labels, remove_labels
+
+
+def match_rules(rules, index):
+    """Match compiled rules against indexed files."""
+
+    matches = Matches(rules)
+    matches.feed(index)
+    return matches.result()
+
+
+def feed(matches, batch, flags):
+    """Index a batch of files and match the undecided rules against it."""
+
+    matches.feed(FileIndex(batch, flags))
+
+
+async def match_files(rules, files, flags):
+    """
+    Match compiled rules against a stream of files, stopping early once every rule is decided.
+
+    Batches with many files and rules are matched off the event loop.
+    """
+
+    matches = Matches(rules)
+    batch = []
+    async for file in files:
+        batch.append(file)
+        if len(batch) >= BATCH_SIZE:
+            await offload.pool.run('glob', len(batch) * len(matches.pending), feed, matches, batch, flags)
+            batch = []
+            if matches.done:
+                break
+
+    if batch and not matches.done:
+        await offload.pool.run('glob', len(batch) * len(matches.pending), feed, matches, batch, flags)
+
+    return matches.result()
+
+
+def get_labels(rules, files, flags):
+    """Sync labels."""
+
+    return match_rules(compile_rules(rules, flags), FileIndex(files, flags))
 
 
 async def wildcard_labels(event, gh, config):
     """Label issues by files that have changed."""
 
-    rules = config.get('rules', [])
-    if rules:
-        flags = get_flags(config)
-        files = await get_changed_files(event, gh)
-        add, remove = get_labels(rules, files, flags)
+    if config.rules:
+        add, remove = await match_files(config.rules, get_changed_files(event, gh), config.flags)
         await update_issue_labels(event, gh, add, remove)
 
 
 async def get_changed_files(event, gh):
-    """Get changed files."""
+    """
+    Get the pull request's changed files one page at a time.
 
-    files = []
-    compare = await gh.getitem(
-        event.compare_url,
-        {'base': event.base, 'head': event.head}
-    )
-    for file in compare['files']:
-        files.append(file['filename'])
-    return files
+    Renamed files yield both their new and previous name. Files read ahead of time are used
+    first, and if they run out early (`None`), every file is listed again.
+    """
+
+    files, event.prefetched_files = event.prefetched_files, None
+    if files is not None:
+        async for file in files:
+            if file is None:
+                break
+            yield file
+        else:
+            return
+
+    async for file in gh.getiter(event.pull_files_url, {'per_page': BATCH_SIZE}):
+        yield file['filename']
+        if 'previous_filename' in file:
+            yield file['previous_filename']
 
 
 async def update_issue_labels(event, gh, add_labels, remove_labels):
@@ -114,14 +354,14 @@ async def pending(event, gh):
     await event.set_status(gh, util.EVT_PENDING, 'labels/auto-labels', 'Pending')
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'wildcard')
 async def run(event, gh, config, **kwargs):
     """Run task."""
 
     print(f'WILDCARD: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('rules')
         await wildcard_labels(event, gh, config)
         success = True
     except Exception:
@@ -1,22 +1,22 @@
 """Handle work in progress labels."""
 import sys
 import traceback
+import cachetools
+from . import metrics
 from . import util
 
 DEFAULT = ('wip', 'work in progress', 'work-in-progress')
 
+# The labels each pull request's WIP status was last set from.
+evaluated = cachetools.TTLCache(maxsize=1024, ttl=600)
+
 
 async def wip(event, gh, config):
     """Handle label events."""
 
-    wip = False
-    wip_list = set([label.lower() for label in config.get('wip', DEFAULT)])
-
     # Grab the labels in this issue event.
-    async for name in event.get_issue_labels(gh):
-        if name.lower() in wip_list:
-            wip = True
-            break
+    labels = frozenset([name.lower() async for name in event.get_issue_labels(gh)])
+    wip = not config.wip.isdisjoint(labels)
 
     print('WIP: ', str(wip))
 
@@ -26,16 +26,23 @@ async def wip(event, gh, config):
         'labels/wip',
         "Work in progress" if wip else "Ready for review"
     )
+    evaluated[event.key] = labels
+
+
+def is_evaluated(event):
+    """Check if the status was last set from the same labels the event reports."""
+
+    return evaluated.get(event.key) == frozenset([name.lower() for name in event.labels])
 
 
+@metrics.timed(metrics.TASK_SECONDS, 'wip')
 async def run(event, gh, config, **kwargs):
     """Run task."""
 
     print(f'WIP: {event.full_name}')
 
     try:
-        if config.get('error', ''):
-            raise Exception(config['error'])
+        config.check('wip')
         await wip(event, gh, config)
         fail = False
     except Exception: